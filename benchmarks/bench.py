@@ -0,0 +1,238 @@
+"""
+Benchmark suite for the amortization math and the HTTP routes.
+
+Seeds a fresh SQLite database with users, loans and shares, then times the
+schedule/summary calculations directly and the main routes through the ASGI app
+in-process (no network). Latency percentiles and throughput for each case are
+written as JSON, and can be compared against an earlier run to catch regressions.
+
+    $ python -m benchmarks.bench --users 200 --loans 2000 --shares 1000 --output results.json
+    $ python -m benchmarks.bench --output new.json --compare results.json --threshold 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+def percentile(sorted_values: list, fraction: float):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(latencies: list, elapsed: float):
+    '''
+    Latency stats in milliseconds, plus throughput over the whole run
+    '''
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 4),
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 4),
+        "p90_ms": round(percentile(ordered, 0.90) * 1000, 4),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 4),
+        "max_ms": round(ordered[-1] * 1000, 4),
+        "ops_per_second": round(len(ordered) / elapsed, 1),
+    }
+
+def time_calls(fn, args_list: list):
+    latencies = []
+    start = time.perf_counter()
+    for args in args_list:
+        call_start = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+async def time_requests(client, requests: list):
+    '''
+    requests is a list of (method, url, kwargs); any non-2xx response aborts the run
+    '''
+    latencies = []
+    start = time.perf_counter()
+    for method, url, kwargs in requests:
+        call_start = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        latencies.append(time.perf_counter() - call_start)
+        if response.status_code >= 300:
+            raise RuntimeError("%s %s returned %d: %s" % (method, url, response.status_code, response.text[:200]))
+    return summarize(latencies, time.perf_counter() - start)
+
+async def time_stream(client, requests: list):
+    '''
+    time_requests for streaming routes, adding throughput in lines (rows) and megabytes per second
+    '''
+    latencies = []
+    lines = size = 0
+    start = time.perf_counter()
+    for method, url, kwargs in requests:
+        call_start = time.perf_counter()
+        async with client.stream(method, url, **kwargs) as response:
+            if response.status_code >= 300:
+                raise RuntimeError("%s %s returned %d" % (method, url, response.status_code))
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                lines += chunk.count(b"\n")
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    stats = summarize(latencies, elapsed)
+    stats.update(rows_per_second=round(lines / elapsed, 1), mb_per_second=round(size / elapsed / 1e6, 3))
+    return stats
+
+def seed(db, rng: random.Random, user_count: int, loan_count: int, share_count: int):
+    '''
+    Fill an empty database through the bulk helpers
+    Returns a list of (loan_id, owner_id, term) and a dict of user_id -> visible loan ids
+    '''
+    from model import bulk, users, loans, loan_access
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+    bulk.create_users(db, [users.UserSchemaBase(username="user%d" % i) for i in range(user_count)])
+    created = bulk.create_loans(db, [
+        loans.LoanSchemaBase(
+            amount=round(rng.uniform(1000, 750000), 2), apr=round(rng.uniform(0.01, 0.25), 4),
+            term=rng.choice([12, 24, 36, 60, 120, 180, 360]), owner_id=rng.randint(1, user_count))
+        for _ in range(loan_count)
+    ])["created"]
+
+    visible = {user_id: set() for user_id in range(1, user_count + 1)}
+    for loan in created:
+        visible[loan["owner_id"]].add(loan["id"])
+    shares = [{"loan_id": rng.choice(created)["id"], "user_id": rng.randint(1, user_count)} for _ in range(share_count)]
+    if shares:
+        db.execute(sqlite_insert(loan_access.LoanAccess.__table__).on_conflict_do_nothing(), shares)
+        db.commit()
+    for share in shares:
+        visible[share["user_id"]].add(share["loan_id"])
+
+    return [(loan["id"], loan["owner_id"], loan["term"]) for loan in created], visible
+
+def run(args):
+    # point the app at a throwaway database before anything imports database.db
+    tmp = tempfile.TemporaryDirectory()
+    path = os.path.join(tmp.name, "bench.db")
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    os.environ["ASYNC_DATABASE_URL"] = "sqlite+aiosqlite:///" + path
+    os.environ["DB_MODE"] = args.db_mode
+    os.environ["DB_PROFILE"] = args.db_profile
+    if args.disable_cache:
+        os.environ["LOAN_CACHE_SIZE"] = "0"
+
+    import httpx
+    from database.db import SessionLocal, engine
+    from main import app
+    from model import loans
+
+    rng = random.Random(args.seed)
+    with SessionLocal() as db:
+        seed_start = time.perf_counter()
+        loan_rows, visible = seed(db, rng, args.users, args.loans, args.shares)
+        seed_seconds = time.perf_counter() - seed_start
+        params = {loan.id: (loan.apr, loan.amount, loan.term) for loan in db.query(loans.Loan)}
+
+    n = args.iterations
+    picks = [rng.choice(loan_rows) for _ in range(n)]
+    users_with_loans = [user_id for user_id, loan_ids in visible.items() if loan_ids]
+    results = {}
+
+    results["calc.get_loan_schedule"] = time_calls(
+        loans.get_loan_schedule, [params[loan_id] for loan_id, _, _ in picks])
+    results["calc.get_loan_summary"] = time_calls(
+        loans.get_loan_summary, [params[loan_id] + (rng.randint(0, term),) for loan_id, _, term in picks])
+
+    async def http_cases():
+        async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+            results["http.GET /users"] = await time_requests(client, [
+                ("GET", "/users", {"params": {"limit": 100}}) for _ in range(n)])
+            results["http.GET /users/{user_id}/loans"] = await time_requests(client, [
+                ("GET", "/users/%d/loans" % rng.choice(users_with_loans), {}) for _ in range(n)])
+            results["http.GET /loans/{loan_id}"] = await time_requests(client, [
+                ("GET", "/loans/%d" % loan_id, {"params": {"user_id": owner_id}}) for loan_id, owner_id, _ in picks])
+            results["http.GET /loans/{loan_id}/month/{month}"] = await time_requests(client, [
+                ("GET", "/loans/%d/month/%d" % (loan_id, rng.randint(0, term)), {"params": {"user_id": owner_id}})
+                for loan_id, owner_id, term in picks])
+            batch_requests = []
+            for _ in range(max(1, n // 10)):
+                user_id = rng.choice(users_with_loans)
+                loan_ids = rng.sample(sorted(visible[user_id]), min(args.batch_size, len(visible[user_id])))
+                batch_requests.append(("POST", "/loans/schedules:batch", {"params": {"user_id": user_id}, "json": loan_ids}))
+            results["http.POST /loans/schedules:batch"] = await time_requests(client, batch_requests)
+
+            # whole-portfolio exports for the user who can see the most loans
+            biggest = max(visible, key=lambda user_id: len(visible[user_id]))
+            exports = max(1, n // 50)
+            for format in ("csv", "ndjson"):
+                results["http.GET /users/{user_id}/portfolio/export %s" % format] = await time_stream(client, [
+                    ("GET", "/users/%d/portfolio/export" % biggest, {"params": {"format": format, "schedule": True}})
+                    for _ in range(exports)])
+
+    asyncio.run(http_cases())
+    engine.dispose()
+    tmp.cleanup()
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+            "seed_seconds": round(seed_seconds, 3),
+        },
+        "results": results,
+    }
+
+def compare(current: dict, baseline: dict, threshold: float, metric: str = "p50_ms"):
+    '''
+    Cases whose metric got worse than the baseline by more than threshold (a fraction)
+    '''
+    regressions = []
+    for name, stats in current["results"].items():
+        before = baseline["results"].get(name)
+        if not before or not before[metric]:
+            continue
+        change = stats[metric] / before[metric] - 1
+        if change > threshold:
+            regressions.append((name, before[metric], stats[metric], change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--loans", type=int, default=1000)
+    parser.add_argument("--shares", type=int, default=500)
+    parser.add_argument("--iterations", type=int, default=500, help="calls per case")
+    parser.add_argument("--batch-size", type=int, default=50, help="loan ids per batch schedule request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db-mode", choices=["sync", "async"], default="sync")
+    parser.add_argument("--db-profile", choices=["default", "production"], default="default")
+    parser.add_argument("--disable-cache", action="store_true", help="turn off the schedule/summary cache")
+    parser.add_argument("--output", help="write results as JSON here")
+    parser.add_argument("--compare", help="baseline JSON from an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed p50 slowdown vs the baseline")
+    args = parser.parse_args()
+
+    report = run(args)
+    for name, stats in report["results"].items():
+        print("%-40s p50 %9.3fms  p90 %9.3fms  p99 %9.3fms  %9.1f ops/s" % (
+            name, stats["p50_ms"], stats["p90_ms"], stats["p99_ms"], stats["ops_per_second"]))
+        if "rows_per_second" in stats:
+            print("%-40s %12.1f rows/s  %9.3f MB/s" % ("", stats["rows_per_second"], stats["mb_per_second"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for name, before, after, change in regressions:
+            print("REGRESSION %s: p50 %.3fms -> %.3fms (+%.0f%%)" % (name, before, after, change * 100))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
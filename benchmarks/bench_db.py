@@ -0,0 +1,88 @@
+"""
+Compare database engine profiles under concurrent load.
+
+Runs the same mix of writes (create a loan and its owner access row, like POST /loans)
+and reads (access-checked loan fetch plus a month summary, like GET /loans/{id}/month/{m})
+from several threads against a fresh SQLite file for each profile, and prints completed
+ops/s. An operation that fails (e.g. "database is locked") is counted as an error, not
+as throughput, and the thread moves on to the next one.
+
+    $ python -m benchmarks.bench_db --threads 8 --ops 500 --write-ratio 0.2
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from sqlalchemy.orm import sessionmaker
+from database.db import Base, create_db_engine
+from model import loans, users, loan_access
+
+def run_profile(profile: str, threads: int, ops: int, write_ratio: float, seed_loans: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_db_engine("sqlite:///%s" % os.path.join(tmp, "bench.db"), profile)
+        Base.metadata.create_all(engine)
+        Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+        with Session() as db:
+            owner = users.create_user(db, users.UserSchemaBase(username="bench"))
+            for _ in range(seed_loans):
+                loan = loans.create_loan(db, loans.LoanSchemaBase(amount=250000.0, apr=0.05, term=360, owner_id=owner.id))
+                loan_access.add_user(db, loan.id, owner.id)
+            owner_id = owner.id
+
+        # per thread, so workers don't contend on shared counters
+        completed = [0] * threads
+        errors = [0] * threads
+        def worker(index: int):
+            rng = random.Random(index)
+            for _ in range(ops):
+                try:
+                    with Session() as db:
+                        if rng.random() < write_ratio:
+                            loan = loans.create_loan(db, loans.LoanSchemaBase(
+                                amount=rng.uniform(1000, 500000), apr=rng.uniform(0.01, 0.2), term=rng.choice([12, 60, 360]),
+                                owner_id=owner_id))
+                            loan_access.add_user(db, loan.id, owner_id)
+                        else:
+                            loan = loan_access.get_loan_for_user(db, rng.randint(1, seed_loans), owner_id)
+                            loans.get_loan_summary(loan.apr, loan.amount, loan.term, rng.randint(0, loan.term))
+                    completed[index] += 1
+                # e.g. "database is locked" under the default profile; count it and carry on
+                except Exception:
+                    errors[index] += 1
+
+        pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        start = time.perf_counter()
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        engine.dispose()
+
+    # failed operations aren't throughput, so only completed ones count
+    return {
+        "profile": profile,
+        "ops": sum(completed),
+        "seconds": round(elapsed, 3),
+        "ops_per_second": round(sum(completed) / elapsed, 1),
+        "errors": sum(errors),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=500, help="operations per thread")
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--seed-loans", type=int, default=200)
+    parser.add_argument("--profiles", nargs="+", default=["default", "production"])
+    args = parser.parse_args()
+
+    for profile in args.profiles:
+        result = run_profile(profile, args.threads, args.ops, args.write_ratio, args.seed_loans)
+        print("%(profile)-12s %(ops)6d ops in %(seconds)7.3fs  %(ops_per_second)8.1f ops/s  %(errors)d errors" % result)
+
+if __name__ == "__main__":
+    main()
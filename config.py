@@ -0,0 +1,74 @@
+import os
+
+# App settings, all overridable from the environment.
+# Modules should read these as config.NAME at call time (not `from config import NAME`)
+# so tests can monkeypatch them. The exceptions are settings that build something at
+# import: the cache and profile store sizes/TTLs, the database URLs and engine/pool
+# settings, and the flags main.py uses to pick middleware and routes. Those are read
+# once at startup, and changing them later has no effect.
+
+def _env_int(name: str, default: int):
+    return int(os.environ.get(name, default))
+
+def _env_float(name: str, default: float):
+    return float(os.environ.get(name, default))
+
+# Schedule/summary cache in model/loans.py, keyed by (apr, amount, term)
+# A size of 0 disables the cache, a TTL of 0 means entries never expire
+# Read when model/loans.py is imported
+LOAN_CACHE_SIZE = _env_int("LOAN_CACHE_SIZE", 1024)
+LOAN_CACHE_TTL = _env_float("LOAN_CACHE_TTL", 300)
+
+# Per-process cache of each user's accessible loan ids in model/loan_access.py
+# Off by default; see the note there before turning it on
+ACCESS_CACHE_SIZE = _env_int("ACCESS_CACHE_SIZE", 0)
+ACCESS_CACHE_TTL = _env_float("ACCESS_CACHE_TTL", 60)
+
+# "sync" serves every route with a blocking Session from the threadpool,
+# "async" swaps in the AsyncSession routes from routes_async.py (aiosqlite)
+DB_MODE = os.environ.get("DB_MODE", "sync")
+
+# "live" computes schedules and summaries on every read, "materialized" stores them in the
+# loan_schedule table when loans are written and serves reads from it (model/loan_schedule.py)
+SCHEDULE_STORAGE = os.environ.get("SCHEDULE_STORAGE", "live")
+
+# Process pool for large amortization jobs (model/offload.py). 0 workers keeps everything inline.
+# Jobs of at least AMORTIZATION_OFFLOAD_THRESHOLD loan-months (sum of terms for schedules,
+# loan count for portfolio summaries) go to the pool, at most AMORTIZATION_MAX_JOBS at a
+# time (0 means one per worker); up to AMORTIZATION_MAX_QUEUED more (0 means one per worker)
+# wait for a slot, and any beyond that get a 503
+AMORTIZATION_WORKERS = _env_int("AMORTIZATION_WORKERS", 0)
+AMORTIZATION_OFFLOAD_THRESHOLD = _env_int("AMORTIZATION_OFFLOAD_THRESHOLD", 20000)
+AMORTIZATION_MAX_JOBS = _env_int("AMORTIZATION_MAX_JOBS", 0)
+AMORTIZATION_MAX_QUEUED = _env_int("AMORTIZATION_MAX_QUEUED", 0)
+
+# Per-route latency and DB query metrics at GET /metrics (metrics.py)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+
+# Per-request profiling (profiling.py): with this on, requests sent with "X-Profile: 1"
+# run under cProfile and the last PROFILE_STORE_SIZE reports are kept for GET /profiles
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") == "1"
+PROFILE_STORE_SIZE = _env_int("PROFILE_STORE_SIZE", 100)
+
+# Database engine (database/db.py)
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///database/greystone.db")
+ASYNC_DATABASE_URL = os.environ.get("ASYNC_DATABASE_URL", "sqlite+aiosqlite:///database/greystone.db")
+# Read-only routes use READ_DATABASE_URL when set (a replica), otherwise the primary
+# (database/replica.py). If the replica can't be reached they fall back to the primary
+# unless READ_REPLICA_FALLBACK=0. A user's reads go to the primary for
+# READ_YOUR_WRITES_SECONDS after they write, so they see their own changes (0 turns this off)
+READ_DATABASE_URL = os.environ.get("READ_DATABASE_URL", "")
+READ_REPLICA_FALLBACK = os.environ.get("READ_REPLICA_FALLBACK", "1") == "1"
+READ_YOUR_WRITES_SECONDS = _env_float("READ_YOUR_WRITES_SECONDS", 5)
+# "default" keeps SQLite's stock settings, "production" applies the pragmas below on
+# every new connection and pools connections so they only pay for that once
+DB_PROFILE = os.environ.get("DB_PROFILE", "default")
+# A pool size of 0 keeps the dialect's default pool (NullPool for SQLite files),
+# unless the production profile is on, in which case it means 5
+DB_POOL_SIZE = _env_int("DB_POOL_SIZE", 0)
+DB_MAX_OVERFLOW = _env_int("DB_MAX_OVERFLOW", 10)
+DB_POOL_TIMEOUT = _env_float("DB_POOL_TIMEOUT", 30)
+DB_POOL_RECYCLE = _env_int("DB_POOL_RECYCLE", -1)
+SQLITE_BUSY_TIMEOUT_MS = _env_int("SQLITE_BUSY_TIMEOUT_MS", 5000)
+SQLITE_MMAP_SIZE = _env_int("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)
+SQLITE_CACHE_SIZE_KB = _env_int("SQLITE_CACHE_SIZE_KB", 64 * 1024)
@@ -1,11 +1,107 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+import config
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///database/greystone.db"
+def sqlite_production_pragmas():
+    '''
+    Pragmas for the production profile, applied to every new SQLite connection
+    WAL lets readers run alongside the single writer, and synchronous=NORMAL only
+    fsyncs at checkpoints, which is still safe against corruption in WAL mode
+    '''
+    return [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=%d" % config.SQLITE_BUSY_TIMEOUT_MS,
+        "PRAGMA mmap_size=%d" % config.SQLITE_MMAP_SIZE,
+        # negative cache_size is in KiB rather than pages
+        "PRAGMA cache_size=-%d" % config.SQLITE_CACHE_SIZE_KB,
+    ]
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+def _apply_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in sqlite_production_pragmas():
+        cursor.execute(pragma)
+    cursor.close()
+
+def _engine_options(url: str, profile: str, pool_class):
+    options = {}
+    if make_url(url).get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+
+    pool_size = config.DB_POOL_SIZE or (5 if profile == "production" else 0)
+    if pool_size:
+        options.update(
+            poolclass=pool_class,
+            pool_size=pool_size,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+            pool_recycle=config.DB_POOL_RECYCLE,
+        )
+    return options
+
+def create_db_engine(url: str = None, profile: str = None):
+    '''
+    Build a sync engine from config, or from the given url/profile
+    '''
+    url = url or config.DATABASE_URL
+    profile = profile or config.DB_PROFILE
+    db_engine = create_engine(url, **_engine_options(url, profile, QueuePool))
+    if profile == "production" and db_engine.dialect.name == "sqlite":
+        event.listen(db_engine, "connect", _apply_pragmas)
+    return db_engine
+
+def create_async_db_engine(url: str = None, profile: str = None):
+    '''
+    Build an async engine from config, or from the given url/profile
+    '''
+    url = url or config.ASYNC_DATABASE_URL
+    profile = profile or config.DB_PROFILE
+    options = _engine_options(url, profile, AsyncAdaptedQueuePool)
+    # aiosqlite runs each connection in its own thread already
+    options.pop("connect_args", None)
+    db_engine = create_async_engine(url, **options)
+    if profile == "production" and db_engine.dialect.name == "sqlite":
+        event.listen(db_engine.sync_engine, "connect", _apply_pragmas)
+    return db_engine
+
+engine = create_db_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Read-only routes go through database/replica.py, which uses this unless it's unreachable
+read_engine = create_db_engine(config.READ_DATABASE_URL) if config.READ_DATABASE_URL else engine
+
+# Used by routes_async.py when config.DB_MODE is "async"
+# expire_on_commit=False so returned objects can be serialized without another (awaited) load
+async_engine = create_async_db_engine()
+AsyncSessionLocal = sessionmaker(
+    bind=async_engine, class_=AsyncSession, autocommit=False, autoflush=False, expire_on_commit=False
+)
+
 Base = declarative_base()
+
+def add_missing_columns(bind):
+    '''
+    ALTER TABLE ADD COLUMN for model columns missing from existing tables
+    create_all only creates whole tables, so this covers columns added to a model later
+    New columns need to be nullable or have a server_default to be added this way
+    '''
+    inspector = inspect(bind)
+    existing_tables = inspector.get_table_names()
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = "ALTER TABLE %s ADD COLUMN %s %s" % (
+                    table.name, column.name, column.type.compile(dialect=bind.dialect))
+                if column.server_default is not None:
+                    ddl += " DEFAULT %s" % column.server_default.arg
+                    if not column.nullable:
+                        ddl += " NOT NULL"
+                connection.execute(text(ddl))
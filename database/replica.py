@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from database import db
+from model.cache import LRUCache
+import config
+import metrics
+
+# Read/write routing. Writes always use db.engine (get_db in main.py); read-only routes
+# take their session from read_session, which picks db.read_engine (READ_DATABASE_URL)
+# except when:
+#   * no replica is configured, so read_engine is the primary anyway
+#   * the user wrote within READ_YOUR_WRITES_SECONDS, so a lagging replica can't hide
+#     their own change from them
+#   * the replica refuses the connection and READ_REPLICA_FALLBACK is on
+# Recent writers are remembered per process, like the access cache, so with several
+# workers read-your-writes only holds for requests that land on the same one.
+#
+# With SQLite files standing in for a primary and replica, open the replica read-only
+# so a missing file fails to connect instead of being created empty:
+#   READ_DATABASE_URL="sqlite:///file:database/replica.db?mode=ro&uri=true"
+
+recent_writers = LRUCache(10000, config.READ_YOUR_WRITES_SECONDS)
+
+def record_write(*user_ids: int):
+    '''
+    Send these users' reads to the primary for the next READ_YOUR_WRITES_SECONDS
+    '''
+    if config.READ_YOUR_WRITES_SECONDS <= 0:
+        return
+    for user_id in user_ids:
+        recent_writers.set(user_id, True)
+
+def _connect(user_id: int = None):
+    if db.read_engine is db.engine:
+        target = "primary"
+    elif user_id is not None and config.READ_YOUR_WRITES_SECONDS > 0 and recent_writers.get(user_id):
+        target = "primary"
+    else:
+        try:
+            connection = db.read_engine.connect()
+        except OperationalError:
+            if not config.READ_REPLICA_FALLBACK:
+                raise
+            target = "fallback"
+        else:
+            metrics.db_read_sessions.inc(("replica",))
+            return connection
+    metrics.db_read_sessions.inc((target,))
+    return db.engine.connect()
+
+@contextmanager
+def read_session(user_id: int = None):
+    '''
+    Session for read-only work on behalf of user_id (None for anonymous reads)
+    '''
+    connection = _connect(user_id)
+    try:
+        with Session(bind=connection, autocommit=False, autoflush=False) as session:
+            yield session
+    finally:
+        connection.close()
@@ -1,12 +1,23 @@
+import orjson
 import uvicorn
-from fastapi import FastAPI, HTTPException, Depends
-from typing import List
-from starlette.responses import RedirectResponse
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
+from typing import List, Optional
+from starlette.responses import RedirectResponse, StreamingResponse, PlainTextResponse
 from sqlalchemy.orm import Session
-from database.db import SessionLocal, engine, Base
-from model import loans, users, loan_access
+from database.db import SessionLocal, engine, Base, add_missing_columns
+from database import replica
+from model import loans, users, loan_access, loan_schedule, pagination, conditional, bulk, offload, export
+import config
+import metrics
+import profiling
+import routes_async
 
 Base.metadata.create_all(bind=engine)
+# create_all skips tables that already exist, so add any columns and indexes introduced since
+add_missing_columns(engine)
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
 
 # TODO: API Versioning
 # (quick solution at https://github.com/DeanWay/fastapi-versioning)
@@ -16,6 +27,23 @@ app = FastAPI(
     version="0.1",
 )
 
+if config.METRICS_ENABLED:
+    metrics.listen_for_queries()
+    app.add_middleware(metrics.MetricsMiddleware)
+
+# Off by default, and nothing (middleware or /profiles routes) is installed unless it's on
+if config.PROFILING_ENABLED:
+    profiling.install(app)
+
+# DB_MODE=async serves the routes in routes_async.py with an AsyncSession instead.
+# Included before the sync routes below so it wins for any path it defines.
+if config.DB_MODE == "async":
+    app.include_router(routes_async.router)
+
+@app.on_event("shutdown")
+def shutdown_offload_pool():
+    offload.shutdown()
+
 def get_db():
     db = SessionLocal()
     try:
@@ -23,6 +51,15 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db(request: Request):
+    """
+    Session for read-only routes: the read replica when one is configured, or the
+    primary if the requesting user_id (path or query) wrote recently, see database/replica.py
+    """
+    user_id = request.path_params.get("user_id") or request.query_params.get("user_id")
+    with replica.read_session(int(user_id) if user_id and user_id.isdigit() else None) as db:
+        yield db
+
 # redirect / to /docs
 @app.get("/", response_class=RedirectResponse)
 def redirect_to_docs():
@@ -34,11 +71,34 @@ def create_user(userData: users.UserSchemaBase, db: Session = Depends(get_db)):
     if err:
         raise err
 
-    return users.create_user(db=db, userData=userData)
+    user = users.create_user(db=db, userData=userData)
+    replica.record_write(user.id)
+    return user
 
 @app.get("/users", response_model=List[users.UserSchema])
-def list_users(db: Session = Depends(get_db)):
-    return users.get_users(db=db)
+def list_users(response: Response, limit: int = pagination.DEFAULT_PAGE_SIZE, after: Optional[int] = None,
+               db: Session = Depends(get_read_db)):
+    """
+    Route to list users, one page at a time
+    Pass the X-Next-Cursor header from the response as after= to get the next page
+    """
+    err = pagination.validate_page_size(limit)
+    if err:
+        raise err
+
+    return pagination.paginate(users.get_users(db=db, after=after, limit=limit + 1), limit, response)
+
+@app.post("/users:bulk", response_model=bulk.UserBulkResultSchema)
+def create_users_bulk(items: List[users.UserSchemaBase], db: Session = Depends(get_db)):
+    """
+    Route to create many users in one transaction
+    Invalid items are skipped and reported in errors by their position in the request
+    """
+    err = bulk.validate_bulk_size(items)
+    if err:
+        raise err
+
+    return bulk.create_users(db=db, items=items)
 
 @app.post("/loans", response_model=loans.LoanSchema)
 def create_loan(loanData: loans.LoanSchemaBase, db: Session = Depends(get_db)):
@@ -56,55 +116,210 @@ def create_loan(loanData: loans.LoanSchemaBase, db: Session = Depends(get_db)):
 
     loan = loans.create_loan(db=db, loanData=loanData)
     loan_access.add_user(db=db, loan_id=loan.id, user_id=loanData.owner_id)
+    replica.record_write(loanData.owner_id)
 
     return loan
 
+@app.post("/loans:bulk", response_model=bulk.LoanBulkResultSchema)
+def create_loans_bulk(items: List[loans.LoanSchemaBase], db: Session = Depends(get_db)):
+    """
+    Route to create many loans in one transaction
+    Each owner is added to their loan's access map, like POST /loans
+    Invalid items and unknown owners are skipped and reported in errors by their position in the request
+    """
+    err = bulk.validate_bulk_size(items)
+    if err:
+        raise err
+
+    result = bulk.create_loans(db=db, items=items)
+    replica.record_write(*{loan["owner_id"] for loan in result["created"]})
+    return result
+
+@app.patch("/loans:bulk", response_model=bulk.LoanBulkUpdateResultSchema)
+def update_loans_bulk(data: bulk.LoanBulkUpdateSchema, user_id: int, db: Session = Depends(get_db)):
+    """
+    Route to change the status and/or apr of every loan the user owns that matches the filter
+    (by loan_ids and/or current status; an empty filter matches all of the user's loans)
+    Runs as one UPDATE in one transaction and returns the ids of the updated loans
+    Returns 409 without changing anything if a matched loan changed mid-update
+    """
+    err = bulk.validate_bulk_update(data)
+    if err:
+        raise err
+
+    try:
+        result = bulk.update_loans(db=db, owner_id=user_id, data=data)
+    except bulk.StaleBulkUpdateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    replica.record_write(user_id)
+    return result
+
 @app.get("/users/{user_id}/loans", response_model=List[loans.LoanSchema])
-def list_user_loans(user_id: int, db: Session = Depends(get_db)):
+def list_user_loans(user_id: int, response: Response, limit: int = pagination.DEFAULT_PAGE_SIZE,
+                    after: Optional[int] = None, db: Session = Depends(get_read_db)):
     """
-    Route to list all loans a user has access to
+    Route to list all loans a user has access to, one page at a time
     This includes loans both owned by and shared with the user
+    Pass the X-Next-Cursor header from the response as after= to get the next page
+    """
+    err = pagination.validate_page_size(limit)
+    if err:
+        raise err
+
+    user = users.get_user_by_id(db=db, id=user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User %d not found" % user_id )
+
+    page = loan_access.get_loans_by_user_id(db=db, user_id=user_id, after=after, limit=limit + 1)
+    return pagination.paginate(page, limit, response)
+
+@app.get("/users/{user_id}/portfolio", response_model=loans.PortfolioSchema)
+def get_user_portfolio(user_id: int, month: int, db: Session = Depends(get_read_db)):
     """
+    Route to summarize every loan a user owns or has been shared, as of the given month
+    Returns the per-loan summaries plus totals across the portfolio
+    Loans with a term shorter than month are reported as paid off
+    """
+    user = users.get_user_by_id(db=db, id=user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User %d not found" % user_id )
+
+    try:
+        portfolio_loans = loan_access.get_loans_by_user_id(db=db, user_id=user_id)
+        portfolio = offload.run(loans.get_portfolio_summary, portfolio_loans, month, size=len(portfolio_loans))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return dict(portfolio, user_id=user_id, month=month)
+
+@app.get("/users/{user_id}/portfolio/export", response_class=StreamingResponse)
+def export_user_portfolio(user_id: int, format: str = "csv", schedule: bool = False, db: Session = Depends(get_read_db)):
+    """
+    Route to download every loan a user owns or has been shared, as CSV or NDJSON
+    schedule=true expands each loan into its monthly schedule
+    Streams in batches off a server-side cursor, so memory use doesn't grow with the portfolio
+    """
+    if format not in export.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Export format must be one of 'csv' or 'ndjson'" )
+
     user = users.get_user_by_id(db=db, id=user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User %d not found" % user_id )
 
-    return loan_access.get_loans_by_user_id(db=db, user_id=user_id)
+    if format == "csv":
+        body, media_type = export.iter_export_csv(db, user_id, schedule), "text/csv"
+    else:
+        body, media_type = export.iter_export_ndjson(db, user_id, schedule), "application/x-ndjson"
+    filename = "portfolio-%d%s.%s" % (user_id, "-schedules" if schedule else "", format)
+    return StreamingResponse(body, media_type=media_type,
+                             headers={"Content-Disposition": 'attachment; filename="%s"' % filename})
+
+@app.post("/loans/schedules:batch", response_model=List[loans.LoanBatchScheduleSchema])
+def get_loan_schedules(loan_ids: List[int], user_id: int, db: Session = Depends(get_read_db)):
+    """
+    Route to return the full monthly schedule for many loans at once
+    Every loan must be owned by or shared with the user
+    """
+    if len(loan_ids) > loans.MAX_BATCH_LOANS:
+        raise HTTPException(status_code=400, detail="At most %d loans per batch" % loans.MAX_BATCH_LOANS )
+    loan_ids = list(dict.fromkeys(loan_ids))
+    visible = {loan.id: loan for loan in loan_access.get_loans_by_ids_for_user(db=db, loan_ids=loan_ids, user_id=user_id)}
+    denied = [loan_id for loan_id in loan_ids if loan_id not in visible]
+    if denied:
+        raise HTTPException(status_code=403, detail="User %d does not have access to loans %s" % (user_id, ", ".join(map(str, denied))) )
+
+    batch = [visible[loan_id] for loan_id in loan_ids]
+    # big batches go to the process pool when it's on, see model/offload.py
+    schedules = offload.run(loans.get_loan_schedules_for_loans, batch, size=sum(loan.term for loan in batch))
+    return Response(orjson.dumps(schedules), media_type="application/json")
 
 @app.get("/loans/{loan_id}", response_model=List[loans.LoanScheduleSchema])
-def get_loan_schedule(loan_id: int, user_id: int, db: Session = Depends(get_db)):
+def get_loan_schedule(loan_id: int, user_id: int, request: Request, from_month: int = 1,
+                      to_month: Optional[int] = None, format: str = "json", db: Session = Depends(get_read_db)):
     """
-    Route to return the full monthly loan schedule
+    Route to return the monthly loan schedule
+    from_month/to_month (inclusive) limit it to a range of months
+    format=ndjson streams one row per line as they are computed
+    format=columnar returns one array per field instead of one object per month
     The loan must be owned by or shared with the user
     """
+    if format not in ["json", "ndjson", "columnar"]:
+        raise HTTPException(status_code=400, detail="Schedule format must be one of 'json', 'ndjson' or 'columnar'" )
+
     # Maybe better to make these failed auth checks return 404s? To obfuscate the real IDs
-    if not loan_access.access_check(db=db, loan_id=loan_id, user_id=user_id):
+    loan = loan_access.get_loan_for_user(db=db, loan_id=loan_id, user_id=user_id)
+    if not loan:
         raise HTTPException(status_code=403, detail="User %d does not have access to loan %d" % (user_id, loan_id) )
 
-    loan = loans.get_loan_by_id(db=db, id=loan_id)
-    if not loan:
-        raise HTTPException(status_code=404, detail="Loan %d not found" % loan_id )
+    # validate up front, a streaming response can't turn into a 400 halfway through,
+    # and a bad range shouldn't get a 304 just because the loan hasn't changed
+    try:
+        loans.validate_month_range(loan.term, from_month, to_month if to_month is not None else loan.term)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers = conditional.cache_headers(loan)
+    if conditional.is_not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    if format == "ndjson":
+        return StreamingResponse(loans.iter_loan_schedule_ndjson(loan, from_month, to_month), media_type="application/x-ndjson", headers=headers)
 
     # Some funky math down this callstack, someone better versed with lending schedules should review
-    return loans.get_loan_schedule_for_loan(loan)
+    rows = loan_schedule.get_schedule_for_loan(db, loan, from_month, to_month)
+    # encoded here rather than through response_model, which would validate every row again
+    encode = loans.schedule_to_columnar_json if format == "columnar" else loans.schedule_to_json
+    return Response(encode(rows), media_type="application/json", headers=headers)
 
 @app.get("/loans/{loan_id}/month/{month}", response_model=loans.LoanSummarySchema)
-def get_loan_summary(loan_id: int, month: int, user_id: int, db: Session = Depends(get_db)):
+def get_loan_summary(loan_id: int, month: int, user_id: int, request: Request, response: Response,
+                     db: Session = Depends(get_read_db)):
     """
     Route to return the loan summary for a given month
     The loan must be owned by or shared with the user
     """
-    if not loan_access.access_check(db=db, loan_id=loan_id, user_id=user_id):
+    loan = loan_access.get_loan_for_user(db=db, loan_id=loan_id, user_id=user_id)
+    if not loan:
         raise HTTPException(status_code=403, detail="User %d does not have access to loan %d" % (user_id, loan_id) )
 
-    loan = loans.get_loan_by_id(db=db, id=loan_id)
+    try:
+        loans.validate_month(loan.term, month)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers = conditional.cache_headers(loan)
+    if conditional.is_not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    try:
+        return loan_schedule.get_summary_for_loan(db, loan, month)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/loans/{loan_id}/scenarios", response_model=List[loans.LoanScenarioResultSchema])
+def get_loan_scenarios(loan_id: int, scenarios: List[loans.LoanScenarioSchema], user_id: int, schedule: bool = False,
+                       db: Session = Depends(get_read_db)):
+    """
+    Route to evaluate what-if scenarios for a loan: an extra principal payment and/or
+    a new APR from a given month, with the rest of the term re-amortized
+    Returns the new monthly payment and total interest per scenario, and the
+    re-amortized months too with schedule=true
+    The loan must be owned by or shared with the user
+    """
+    if len(scenarios) > loans.MAX_SCENARIOS:
+        raise HTTPException(status_code=400, detail="At most %d scenarios per request" % loans.MAX_SCENARIOS )
+
+    loan = loan_access.get_loan_for_user(db=db, loan_id=loan_id, user_id=user_id)
     if not loan:
-        raise HTTPException(status_code=404, detail="Loan %d not found" % loan_id )
+        raise HTTPException(status_code=403, detail="User %d does not have access to loan %d" % (user_id, loan_id) )
 
+    size = sum(loan.term - scenario.month + 1 for scenario in scenarios) if schedule else len(scenarios)
     try:
-        return loans.get_loan_summary_for_loan(loan, month)
+        results = offload.run(loans.get_loan_scenarios, loan, scenarios, schedule, size=size)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    return Response(orjson.dumps(results), media_type="application/json")
 
 @app.put("/loans/{loan_id}", response_model=loans.LoanSchema)
 def update_loan(loan_id: int, loan_data: loans.LoanSchemaBase, user_id: int, db: Session = Depends(get_db)):
@@ -123,7 +338,9 @@ def update_loan(loan_id: int, loan_data: loans.LoanSchemaBase, user_id: int, db:
     if not user_id == loan.owner_id:
         raise HTTPException(status_code=403, detail="User %d does not have access to update loan %d" % (user_id, loan_id) )
 
-    return loans.update_loan(db=db, loan=loan, loanData=loan_data)
+    loan = loans.update_loan(db=db, loan=loan, loanData=loan_data)
+    replica.record_write(user_id, loan.owner_id)
+    return loan
 
 @app.post("/loans/{loan_id}/share")
 def share_loan(loan_id: int, owner_id: int, user_id: int, db: Session = Depends(get_db)):
@@ -131,18 +348,69 @@ def share_loan(loan_id: int, owner_id: int, user_id: int, db: Session = Depends(
     Route to share a loan with a user at user_id
     The loan must be owned by the user at owner_id
     """
-    loan = loans.get_loan_by_id(db=db, id=loan_id)
-    if not loan:
+    loan_owner_id, user_exists = loan_access.get_share_check(db=db, loan_id=loan_id, user_id=user_id)
+    if loan_owner_id is None:
         raise HTTPException(status_code=404, detail="Loan %d not found" % loan_id )
 
-    user = users.get_user_by_id(db=db, id=user_id)
-    if not user:
+    if not user_exists:
         raise HTTPException(status_code=404, detail="User %d not found" % user_id )
 
-    if loan.owner_id != owner_id:
+    if loan_owner_id != owner_id:
         raise HTTPException(status_code=403, detail="User %d does not own loan %d" % (owner_id, loan_id) )
 
-    return {"success"} if loan_access.add_user(db=db, loan_id=loan_id, user_id=user_id) else {"failure"}
+    shared = loan_access.add_user(db=db, loan_id=loan_id, user_id=user_id)
+    replica.record_write(owner_id, user_id)
+    return {"success"} if shared else {"failure"}
+
+@app.post("/loans/shares:grant", response_model=bulk.ShareGrantResultSchema)
+def share_loans_bulk(items: List[bulk.LoanShareSchema], owner_id: int, db: Session = Depends(get_db)):
+    """
+    Route to share many loans with many users at once, as (loan_id, user_id) pairs
+    Every loan must be owned by the user at owner_id and every user must exist, or nothing is shared
+    Pairs that are already shared are skipped; granted counts the new ones
+    """
+    err = bulk.validate_shares(db=db, owner_id=owner_id, items=items)
+    if err:
+        raise err
+
+    pairs = bulk.share_pairs(items)
+    granted = loan_access.add_users(db=db, pairs=pairs)
+    replica.record_write(owner_id, *{user_id for _, user_id in pairs})
+    return {"granted": granted}
+
+@app.post("/loans/shares:revoke", response_model=bulk.ShareRevokeResultSchema)
+def revoke_loans_bulk(items: List[bulk.LoanShareSchema], owner_id: int, db: Session = Depends(get_db)):
+    """
+    Route to take away access to many loans from many users at once, as (loan_id, user_id) pairs
+    Every loan must be owned by the user at owner_id, or nothing is revoked
+    Pairs that weren't shared are skipped; revoked counts the ones that were
+    """
+    err = bulk.validate_shares(db=db, owner_id=owner_id, items=items, revoke=True)
+    if err:
+        raise err
+
+    pairs = bulk.share_pairs(items)
+    revoked = loan_access.remove_users(db=db, pairs=pairs)
+    replica.record_write(owner_id, *{user_id for _, user_id in pairs})
+    return {"revoked": revoked}
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    """
+    Hit/miss/eviction counters for the schedule and summary caches
+    """
+    return loans.cache_stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Prometheus text format metrics: per-route latency, DB queries per request,
+    amortization time and cache counters
+    """
+    cache_stats = {"schedule": loans.schedule_cache.stats(), "summary": loans.summary_cache.stats(),
+                   "access": loan_access.access_cache.stats()}
+    return PlainTextResponse(metrics.render(metrics.render_cache_stats(cache_stats)),
+                             media_type="text/plain; version=0.0.4")
 
 # Run the API
 if __name__ == "__main__":
@@ -0,0 +1,287 @@
+import time
+from contextlib import contextmanager
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# In-process metrics, exposed in the Prometheus text format at GET /metrics.
+# Hand rolled instead of pulling in prometheus_client: a few counters and histograms,
+# each behind its own lock, is all we need, and each observation is a dict lookup and a bisect.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+class _Metric:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = Lock()
+
+    def reset(self):
+        with self._lock:
+            self.values.clear()
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted(self.values.items())
+
+class Counter(_Metric):
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self, label_names: tuple):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        for labels, value in self._snapshot():
+            lines.append("%s%s %s" % (self.name, _format_labels(label_names, labels), _format_value(value)))
+        return lines
+
+class Histogram(_Metric):
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        # values is labels -> [per-bucket counts (last one is +Inf), sum]
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value: float, labels: tuple = ()):
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+
+    def render(self, label_names: tuple):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        for labels, (counts, total) in self._snapshot():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = _format_labels(label_names + ("le",), labels + (_format_value(bound),))
+                lines.append("%s_bucket%s %d" % (self.name, bucket_labels, cumulative))
+            lines.append("%s_sum%s %s" % (self.name, _format_labels(label_names, labels), _format_value(total)))
+            lines.append("%s_count%s %d" % (self.name, _format_labels(label_names, labels), cumulative))
+        return lines
+
+class Gauge(_Metric):
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+    def render(self, label_names: tuple):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s gauge" % self.name]
+        for labels, value in self._snapshot():
+            lines.append("%s%s %s" % (self.name, _format_labels(label_names, labels), _format_value(value)))
+        return lines
+
+def _format_labels(names: tuple, values: tuple):
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in zip(names, values))
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+ROUTE_LABELS = ("method", "route")
+
+http_requests = Counter("http_requests_total", "HTTP requests by route template and status")
+http_request_seconds = Histogram("http_request_duration_seconds", "HTTP request latency by route template")
+http_request_db_queries = Histogram("http_request_db_queries", "Database queries issued per HTTP request", COUNT_BUCKETS)
+http_request_db_seconds = Histogram("http_request_db_seconds", "Time spent in database queries per HTTP request")
+db_queries = Counter("db_queries_total", "Database queries, including ones outside a request")
+db_query_seconds = Counter("db_query_seconds_total", "Time spent in database queries")
+db_read_sessions = Counter("db_read_sessions_total", "Read-only sessions by where they were served (replica, primary, fallback)")
+amortization_seconds = Histogram("amortization_duration_seconds", "Time spent in amortization math by function")
+amortization_jobs = Counter("amortization_jobs_total", "Amortization jobs by function and where they ran (inline or pool), or rejected with the pool queue full")
+amortization_pool_queued = Gauge("amortization_pool_queued_jobs", "Jobs waiting for a free amortization pool slot")
+amortization_pool_running = Gauge("amortization_pool_running_jobs", "Jobs running in the amortization process pool")
+amortization_pool_wait_seconds = Histogram("amortization_pool_wait_seconds", "Time jobs waited for an amortization pool slot")
+
+class RequestStats:
+    __slots__ = ("db_queries", "db_seconds")
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+
+# Set for the duration of each request; anyio copies the context into the threadpool,
+# so sync routes update the same RequestStats object
+_request_stats: ContextVar = ContextVar("request_stats", default=None)
+
+def reset():
+    for metric in (http_requests, http_request_seconds, http_request_db_queries, http_request_db_seconds,
+                   db_queries, db_query_seconds, db_read_sessions, amortization_seconds, amortization_jobs,
+                   amortization_pool_wait_seconds):
+        metric.reset()
+
+# Database
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_times", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start_times"].pop()
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.db_queries += 1
+        stats.db_seconds += elapsed
+    db_queries.inc()
+    db_query_seconds.inc(amount=elapsed)
+
+def _handle_error(exception_context):
+    # a statement that fails in the cursor never reaches after_cursor_execute, so drop
+    # its start time here or it stays on the pooled connection
+    connection = exception_context.connection
+    if connection is not None:
+        start_times = connection.info.get("query_start_times")
+        if start_times:
+            start_times.pop()
+
+def listen_for_queries():
+    '''
+    Time every statement on every engine into the db_* metrics; only called when
+    METRICS_ENABLED, so queries pay nothing for it otherwise
+    '''
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+
+class QueryCounter:
+    __slots__ = ("statements",)
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+@contextmanager
+def count_queries():
+    '''
+    Collect every statement any engine runs inside the with block, from any thread
+    (so it sees what a TestClient request did), for asserting query budgets in tests:
+
+        with metrics.count_queries() as queries:
+            client.get("/users")
+        assert queries.count <= 1, queries.statements
+    '''
+    counter = QueryCounter()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        counter.statements.append(statement)
+
+    event.listen(Engine, "after_cursor_execute", record)
+    try:
+        yield counter
+    finally:
+        event.remove(Engine, "after_cursor_execute", record)
+
+# Amortization
+
+def track_amortization(fn):
+    '''
+    Decorator recording how long each call spends in fn under amortization_duration_seconds
+    '''
+    labels = (fn.__name__,)
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            amortization_seconds.observe(time.perf_counter() - start, labels)
+    return wrapper
+
+# HTTP
+
+def _route_template(scope):
+    # the router leaves the matched endpoint in the scope; look up its path template
+    # so /loans/1 and /loans/2 share a series. Unmatched paths share one series too.
+    endpoint = scope.get("endpoint")
+    app = scope.get("app")
+    if endpoint is None or app is None:
+        return "unmatched"
+    templates = getattr(app.state, "metrics_route_templates", None)
+    if templates is None:
+        templates = {getattr(route, "endpoint", None): route.path for route in app.router.routes}
+        app.state.metrics_route_templates = templates
+    return templates.get(endpoint, "unmatched")
+
+class MetricsMiddleware:
+    '''
+    Plain ASGI middleware (BaseHTTPMiddleware would buffer streaming responses)
+    Records latency, status, DB query count and DB time per route template
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_stats.reset(token)
+            labels = (scope["method"], _route_template(scope))
+            http_requests.inc(labels + (status[0],))
+            http_request_seconds.observe(elapsed, labels)
+            http_request_db_queries.observe(stats.db_queries, labels)
+            http_request_db_seconds.observe(stats.db_seconds, labels)
+
+def render(extra_lines: list = ()):
+    '''
+    Everything above in the Prometheus text exposition format
+    '''
+    lines = http_requests.render(ROUTE_LABELS + ("status",))
+    for histogram in (http_request_seconds, http_request_db_queries, http_request_db_seconds):
+        lines += histogram.render(ROUTE_LABELS)
+    lines += db_queries.render(())
+    lines += db_query_seconds.render(())
+    lines += db_read_sessions.render(("target",))
+    lines += amortization_seconds.render(("function",))
+    lines += amortization_jobs.render(("function", "executor"))
+    lines += amortization_pool_queued.render(())
+    lines += amortization_pool_running.render(())
+    lines += amortization_pool_wait_seconds.render(())
+    lines += list(extra_lines)
+    return "\n".join(lines) + "\n"
+
+def render_cache_stats(cache_stats: dict):
+    '''
+    Counters/gauges for LRUCache.stats() dicts, keyed by cache name
+    '''
+    lines = []
+    for field, kind in (("hits", "counter"), ("misses", "counter"), ("evictions", "counter"),
+                        ("expirations", "counter"), ("invalidations", "counter"), ("size", "gauge")):
+        name = "loan_cache_%s%s" % (field, "_total" if kind == "counter" else "")
+        lines.append("# TYPE %s %s" % (name, kind))
+        for cache, stats in sorted(cache_stats.items()):
+            lines.append('%s{cache="%s"} %d' % (name, cache, stats[field]))
+    return lines
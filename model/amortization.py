@@ -0,0 +1,145 @@
+import numpy as np
+
+# Vectorized versions of the schedule math in model/loans.py.
+# Each loan is one row; months run along the columns. Loans with shorter terms
+# are padded out to the longest term in the batch, and the padding is masked off.
+
+SCHEDULE_FIELDS = ("month", "open_balance", "total_payment", "principal_payment", "interest_payment", "close_balance")
+
+def _as_columns(aprs, amounts, terms):
+    aprs = np.asarray(aprs, dtype=np.float64).reshape(-1, 1)
+    amounts = np.asarray(amounts, dtype=np.float64).reshape(-1, 1)
+    terms = np.asarray(terms, dtype=np.int64).reshape(-1, 1)
+    if not (aprs.shape == amounts.shape == terms.shape):
+        raise ValueError("aprs, amounts and terms must be the same length")
+    return aprs, amounts, terms
+
+def calc_monthly_total_payments(aprs, amounts, terms):
+    aprs, amounts, terms = _as_columns(aprs, amounts, terms)
+    monthly_rates = aprs / 12
+    temp_val = (monthly_rates + 1) ** terms
+    return (amounts * ((monthly_rates * temp_val) / (temp_val - 1))).ravel()
+
+def calc_remaining_balances(aprs, amounts, terms, months):
+    '''
+    Balance of each loan after months[i] payments, in closed form
+    months may be a scalar or one value per loan
+    '''
+    aprs, amounts, terms = _as_columns(aprs, amounts, terms)
+    months = np.broadcast_to(np.asarray(months, dtype=np.int64).reshape(-1, 1), terms.shape)
+    monthly_rates = aprs / 12
+    payments = calc_monthly_total_payments(aprs, amounts, terms).reshape(-1, 1)
+    growth = (monthly_rates + 1) ** months
+    balances = amounts * growth - payments * (growth - 1) / monthly_rates
+    # keep month 0 exact, like the scalar version
+    return np.where(months == 0, amounts, balances).ravel()
+
+def get_loan_summaries(aprs, amounts, terms, months):
+    '''
+    Vectorized get_loan_summary
+    Returns a dict of arrays, one entry per loan
+    '''
+    aprs, amounts, terms = _as_columns(aprs, amounts, terms)
+    months = np.broadcast_to(np.asarray(months, dtype=np.int64).reshape(-1, 1), terms.shape)
+    if (months < 0).any():
+        raise ValueError("Month must be greater than or equal to zero")
+    if (months > terms).any():
+        raise ValueError("Month must be less than or equal to the loan term")
+
+    payments = calc_monthly_total_payments(aprs, amounts, terms)
+    balances = calc_remaining_balances(aprs, amounts, terms, months)
+    principal_paid = amounts.ravel() - balances
+    return {
+        "current_principal": balances,
+        "aggregate_principal_paid": principal_paid,
+        "aggregate_interest_paid": months.ravel() * payments - principal_paid,
+    }
+
+def get_loan_schedules(aprs, amounts, terms):
+    '''
+    Vectorized get_loan_schedule for a batch of loans with possibly different terms
+    Returns a dict of (loan count x longest term) arrays keyed by SCHEDULE_FIELDS,
+    plus a boolean "mask" array marking which cells are real months
+    '''
+    aprs, amounts, terms = _as_columns(aprs, amounts, terms)
+    max_term = int(terms.max()) if terms.size else 0
+    months = np.arange(1, max_term + 1, dtype=np.int64).reshape(1, -1)
+    mask = months <= terms
+
+    monthly_rates = aprs / 12
+    payments = calc_monthly_total_payments(aprs, amounts, terms).reshape(-1, 1)
+    # balance at the start of each month, from the closed form rather than a running loop
+    growth = (monthly_rates + 1) ** (months - 1)
+    open_balances = amounts * growth - payments * (growth - 1) / monthly_rates
+    interest_payments = open_balances * monthly_rates
+    principal_payments = payments - interest_payments
+
+    return {
+        "month": np.broadcast_to(months, mask.shape),
+        "open_balance": open_balances,
+        "total_payment": np.broadcast_to(payments, mask.shape),
+        "principal_payment": principal_payments,
+        "interest_payment": interest_payments,
+        "close_balance": open_balances - principal_payments,
+        "mask": mask,
+    }
+
+def schedule_rows(schedules, index: int):
+    '''
+    Unpack one loan's schedule from get_loan_schedules into a list of row dicts
+    '''
+    term = int(schedules["mask"][index].sum())
+    columns = [schedules[field][index, :term].tolist() for field in SCHEDULE_FIELDS]
+    return [dict(zip(SCHEDULE_FIELDS, row)) for row in zip(*columns)]
+
+def get_scenarios(apr: float, amount: float, term: int, months, extra_payments, new_aprs, include_schedules: bool = False):
+    '''
+    What-if scenarios for one loan: from month k (months[i]) on, the borrower pays
+    extra_payments[i] off the principal up front and the loan reprices to new_aprs[i],
+    then the remaining term - k + 1 months are re-amortized at the new payment.
+
+    The balance going into month k comes from the closed form, and the remainder is just
+    a fresh loan of that balance, so every scenario is evaluated in the same vectorized
+    pass without building the original schedule. Returns a dict of arrays, one entry per
+    scenario, plus "schedules" (as from get_loan_schedules, months numbered from the
+    original loan's month 1) when include_schedules is set.
+    '''
+    months = np.asarray(months, dtype=np.int64).ravel()
+    extra_payments = np.asarray(extra_payments, dtype=np.float64).ravel()
+    new_aprs = np.asarray(new_aprs, dtype=np.float64).ravel()
+    if not (months.shape == extra_payments.shape == new_aprs.shape):
+        raise ValueError("months, extra_payments and new_aprs must be the same length")
+    if ((months < 1) | (months > term)).any():
+        raise ValueError("Scenario month must be between 1 and the loan term")
+    if (extra_payments < 0).any():
+        raise ValueError("Scenario extra_payment must be greater than or equal to zero")
+    if (new_aprs <= 0).any():
+        raise ValueError("Scenario apr must be greater than zero")
+
+    count = months.shape[0]
+    original = [np.full(count, apr), np.full(count, amount), np.full(count, term)]
+    before = get_loan_summaries(*original, months - 1)
+    balances = before["current_principal"]
+    if (extra_payments > balances + amount * 1e-9).any():
+        raise ValueError("Scenario extra_payment must not be more than the balance going into that month")
+
+    new_balances = np.maximum(balances - extra_payments, 0)
+    remaining_terms = term - months + 1
+    payments = calc_monthly_total_payments(new_aprs, new_balances, remaining_terms)
+    total_interest = before["aggregate_interest_paid"] + remaining_terms * payments - new_balances
+    baseline_interest = term * calc_monthly_total_payments([apr], [amount], [term])[0] - amount
+
+    scenarios = {
+        "month": months,
+        "extra_payment": extra_payments,
+        "apr": new_aprs,
+        "balance": balances,
+        "monthly_payment": payments,
+        "total_interest": total_interest,
+        "interest_saved": baseline_interest - total_interest,
+    }
+    if include_schedules:
+        schedules = get_loan_schedules(new_aprs, new_balances, remaining_terms)
+        schedules["month"] = schedules["month"] + (months - 1).reshape(-1, 1)
+        scenarios["schedules"] = schedules
+    return scenarios
@@ -0,0 +1,240 @@
+from typing import List, Optional
+from datetime import datetime
+from sqlalchemy import insert, update, select, func, tuple_
+from sqlalchemy.orm import Session
+from pydantic import BaseModel
+from fastapi import HTTPException
+from model import users, loans, loan_access, loan_schedule
+
+MAX_BULK_ITEMS = 5000
+
+class BulkErrorSchema(BaseModel):
+    index: int
+    detail: str
+
+class UserBulkResultSchema(BaseModel):
+    created: List[users.UserSchema]
+    errors: List[BulkErrorSchema]
+
+class LoanBulkResultSchema(BaseModel):
+    created: List[loans.LoanSchema]
+    errors: List[BulkErrorSchema]
+
+class LoanBulkFilterSchema(BaseModel):
+    loan_ids: Optional[List[int]] = None
+    status: Optional[str] = None
+
+class LoanBulkChangesSchema(BaseModel):
+    status: Optional[str] = None
+    apr: Optional[float] = None
+
+class LoanBulkUpdateSchema(BaseModel):
+    filter: LoanBulkFilterSchema = LoanBulkFilterSchema()
+    changes: LoanBulkChangesSchema
+
+class LoanBulkUpdateResultSchema(BaseModel):
+    updated: List[int]
+
+class StaleBulkUpdateError(Exception):
+    '''
+    Some of the loans matched by a bulk update changed before the UPDATE ran
+    '''
+
+class LoanShareSchema(BaseModel):
+    loan_id: int
+    user_id: int
+
+class ShareGrantResultSchema(BaseModel):
+    granted: int
+
+class ShareRevokeResultSchema(BaseModel):
+    revoked: int
+
+def validate_bulk_size(items: list):
+    '''
+    Returns:
+        HTTPException if there are too many items for one request
+        None otherwise
+    '''
+    if len(items) > MAX_BULK_ITEMS:
+        return HTTPException(status_code=400, detail="At most %d items can be created at once" % MAX_BULK_ITEMS)
+    return None
+
+def _ids_are_sequential(db: Session, model):
+    '''
+    True when an executemany INSERT's new ids are exactly the last len(rows) ids: SQLite
+    rowid tables without AUTOINCREMENT hand them out as max(id) + 1, and nothing else can
+    insert while this transaction holds the write lock. Other databases make no such promise.
+    '''
+    return db.get_bind().dialect.name == "sqlite" and not model.__table__.kwargs.get("sqlite_autoincrement")
+
+def insert_many(db: Session, model, rows: List[dict]):
+    '''
+    INSERT all rows and return their new ids, in order
+    SQLite can't RETURNING from an executemany, so where _ids_are_sequential the rows go in
+    with one executemany and the ids are read back as the last len(rows). Anywhere else
+    each row is inserted on its own for its primary key, which is slower but always right.
+    '''
+    if not rows:
+        return []
+    if not _ids_are_sequential(db, model):
+        return [db.execute(insert(model.__table__), row).inserted_primary_key[0] for row in rows]
+    db.execute(insert(model.__table__), rows)
+    last_id = db.query(func.max(model.id)).scalar()
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+def create_users(db: Session, items: List[users.UserSchemaBase]):
+    '''
+    Validate and insert many users in one transaction
+    Invalid items are skipped and reported by their index in items
+    '''
+    errors = []
+    valid = []
+    for index, userData in enumerate(items):
+        err = users.validate_user(userData)
+        if err:
+            errors.append({"index": index, "detail": err.detail})
+        else:
+            valid.append(userData.dict())
+
+    ids = insert_many(db, users.User, valid)
+    db.commit()
+    return {
+        "created": [dict(row, id=id) for row, id in zip(valid, ids)],
+        "errors": errors,
+    }
+
+def create_loans(db: Session, items: List[loans.LoanSchemaBase]):
+    '''
+    Validate and insert many loans, plus their owners' access rows, in one transaction
+    Owners are looked up with one query; invalid items and unknown owners are skipped
+    and reported by their index in items
+    '''
+    errors = []
+    candidates = []
+    for index, loanData in enumerate(items):
+        err = loans.validateLoan(loanData)
+        if err:
+            errors.append({"index": index, "detail": err.detail})
+        else:
+            candidates.append((index, loanData))
+
+    owner_ids = {loanData.owner_id for _, loanData in candidates}
+    existing_owners = {id for (id,) in db.query(users.User.id).filter(users.User.id.in_(owner_ids))} if owner_ids else set()
+
+    valid = []
+    for index, loanData in candidates:
+        if loanData.owner_id in existing_owners:
+            valid.append(loanData.dict())
+        else:
+            errors.append({"index": index, "detail": "User %d not found" % loanData.owner_id})
+
+    ids = insert_many(db, loans.Loan, valid)
+    created = [dict(row, id=id) for row, id in zip(valid, ids)]
+    if created:
+        db.execute(insert(loan_access.LoanAccess.__table__),
+                   [{"loan_id": loan["id"], "user_id": loan["owner_id"]} for loan in created])
+        # core inserts skip the ORM flush hook, so store schedules here
+        if loan_schedule.is_materialized():
+            loan_schedule.write_schedules(db.connection(), [loans.LoanSchema(**loan) for loan in created])
+    db.commit()
+
+    for owner_id in owner_ids:
+        loan_access.invalidate_access(owner_id)
+
+    errors.sort(key=lambda error: error["index"])
+    return {
+        "created": created,
+        "errors": errors,
+    }
+
+def validate_bulk_update(data: LoanBulkUpdateSchema):
+    '''
+    Returns:
+        HTTPException if the filter or changes are invalid
+        None otherwise
+    '''
+    changes = data.changes
+    if changes.status is None and changes.apr is None:
+        return HTTPException(status_code=400, detail="Nothing to change, set status and/or apr")
+    if changes.status is not None and changes.status not in ["active", "inactive"]:
+        return HTTPException(status_code=400, detail="Loan status must be either 'active' or 'inactive'" )
+    if changes.apr is not None and changes.apr <= 0:
+        return HTTPException(status_code=400, detail="Loan interest_rate must be greater than zero" )
+    if data.filter.loan_ids is not None and len(data.filter.loan_ids) > MAX_BULK_ITEMS:
+        return HTTPException(status_code=400, detail="At most %d loan ids can be updated at once" % MAX_BULK_ITEMS)
+    return None
+
+def update_loans(db: Session, owner_id: int, data: LoanBulkUpdateSchema):
+    '''
+    Apply data.changes to every loan owned by owner_id that matches data.filter,
+    with one UPDATE in one transaction
+    The matching rows are read first for their ids and old params, so only their cached
+    schedules are dropped and, when apr changes, only their stored schedules are rewritten.
+    That read happens before the write transaction starts, so the UPDATE only targets the
+    (id, version) pairs read and must hit all of them; if another writer changed one in
+    between, everything is rolled back and StaleBulkUpdateError raised. Returns the updated ids.
+    '''
+    conditions = [loans.Loan.owner_id == owner_id]
+    if data.filter.status is not None:
+        conditions.append(loans.Loan.status == data.filter.status)
+    if data.filter.loan_ids is not None:
+        conditions.append(loans.Loan.id.in_(data.filter.loan_ids))
+
+    matched = db.execute(select(loans.Loan.id, loans.Loan.version, loans.Loan.amount, loans.Loan.apr, loans.Loan.term)
+                         .where(*conditions).order_by(loans.Loan.id)).all()
+    if not matched:
+        return {"updated": []}
+
+    ids = [row.id for row in matched]
+    read_versions = [(row.id, row.version) for row in matched]
+    values = {field: value for field, value in data.changes.dict().items() if value is not None}
+    result = db.execute(
+        update(loans.Loan).where(tuple_(loans.Loan.id, loans.Loan.version).in_(read_versions))
+        .values(version=loans.Loan.version + 1, updated_at=datetime.utcnow(), **values)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != len(ids):
+        db.rollback()
+        raise StaleBulkUpdateError("%d of %d matched loans changed before they could be updated" % (len(ids) - result.rowcount, len(ids)))
+    # core updates skip the ORM flush hook too
+    if "apr" in values and loan_schedule.is_materialized():
+        loan_schedule.write_schedules(db.connection(), [
+            loans.LoanSchema(id=row.id, amount=row.amount, apr=values["apr"], term=row.term, owner_id=owner_id)
+            for row in matched])
+    db.commit()
+
+    for row in matched:
+        loans.invalidate_cached_schedule(row)
+    return {"updated": ids}
+
+def validate_shares(db: Session, owner_id: int, items: List[LoanShareSchema], revoke: bool = False):
+    '''
+    Check a batch of shares (or revokes) all at once: every loan must exist and be owned by
+    owner_id, and for grants every user must exist. Two queries however big the batch is.
+    Returns:
+        HTTPException for the first kind of problem found, naming every offending id
+        None otherwise
+    '''
+    if len(items) > MAX_BULK_ITEMS:
+        return HTTPException(status_code=400, detail="At most %d shares can be changed at once" % MAX_BULK_ITEMS)
+    loan_ids = sorted({item.loan_id for item in items})
+    user_ids = sorted({item.user_id for item in items})
+    owners, existing_users = loan_access.get_share_checks(db, loan_ids, [] if revoke else user_ids)
+
+    missing_loans = [loan_id for loan_id in loan_ids if loan_id not in owners]
+    if missing_loans:
+        return HTTPException(status_code=404, detail="Loans %s not found" % ", ".join(map(str, missing_loans)))
+    missing_users = [] if revoke else [user_id for user_id in user_ids if user_id not in existing_users]
+    if missing_users:
+        return HTTPException(status_code=404, detail="Users %s not found" % ", ".join(map(str, missing_users)))
+    not_owned = [loan_id for loan_id in loan_ids if owners[loan_id] != owner_id]
+    if not_owned:
+        return HTTPException(status_code=403, detail="User %d does not own loans %s" % (owner_id, ", ".join(map(str, not_owned))))
+    if revoke and any(item.user_id == owner_id for item in items):
+        return HTTPException(status_code=400, detail="Can't revoke an owner's access to their own loan")
+    return None
+
+def share_pairs(items: List[LoanShareSchema]):
+    # duplicates are harmless to the statements, but would inflate the result counts
+    return list(dict.fromkeys((item.loan_id, item.user_id) for item in items))
@@ -0,0 +1,89 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+_MISSING = object()
+
+class LRUCache:
+    '''
+    Small thread-safe LRU cache with an optional TTL
+    Routes run in a threadpool, so every access goes through the lock
+    '''
+    def __init__(self, maxsize: int, ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None, record: bool = True):
+        '''
+        record=False leaves the hit/miss counters alone, for callers whose values are
+        containers and who count hits themselves with record_lookup
+        '''
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += record
+                return default
+            value, expires_at = entry
+            if expires_at and expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += record
+                return default
+            self._data.move_to_end(key)
+            self.hits += record
+            return value
+
+    def record_lookup(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, _MISSING) is not _MISSING:
+                self.invalidations += 1
+
+    def values(self):
+        '''
+        Snapshot of the cached values, least recently used first
+        Doesn't count as hits or refresh recency; expired entries are left out
+        '''
+        now = time.monotonic()
+        with self._lock:
+            return [value for value, expires_at in self._data.values() if not expires_at or expires_at >= now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,72 @@
+import csv
+import io
+import orjson
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from model import amortization, loans
+from model.loans import Loan
+from model.loan_access import LoanAccess
+
+# Streaming portfolio exports for GET /users/{user_id}/portfolio/export.
+# Loans come off a server-side cursor (yield_per) one batch at a time as plain rows,
+# so nothing lands in the session's identity map, and each batch's schedules are
+# computed in one vectorized pass and written out before the next batch is fetched.
+# Memory stays at one batch no matter how big the portfolio is.
+
+EXPORT_BATCH_SIZE = 500
+EXPORT_FORMATS = ("csv", "ndjson")
+LOAN_FIELDS = ("id", "amount", "apr", "term", "status", "owner_id")
+
+def _loan_batches(db: Session, user_id: int, batch_size: int):
+    columns = [getattr(Loan, field) for field in LOAN_FIELDS]
+    query = select(*columns).join(LoanAccess, LoanAccess.loan_id == Loan.id).where(
+        LoanAccess.user_id == user_id).order_by(LoanAccess.loan_id).execution_options(yield_per=batch_size)
+    return db.execute(query).partitions()
+
+def _with_schedules(batch: list, include_schedule: bool):
+    '''
+    (loan row, schedule) pairs, the schedule as a list of month tuples in SCHEDULE_FIELDS order
+    '''
+    if not include_schedule:
+        return [(row, None) for row in batch]
+    schedules = amortization.get_loan_schedules(
+        [row.apr for row in batch], [row.amount for row in batch], [row.term for row in batch])
+    pairs = []
+    for i, row in enumerate(batch):
+        columns = [schedules[field][i, :row.term].tolist() for field in loans.SCHEDULE_FIELDS]
+        pairs.append((row, list(zip(*columns))))
+    return pairs
+
+def iter_export_ndjson(db: Session, user_id: int, include_schedule: bool = False, batch_size: int = None):
+    '''
+    One JSON object per loan per line, with a "schedule" list when include_schedule is set
+    '''
+    for batch in _loan_batches(db, user_id, batch_size or EXPORT_BATCH_SIZE):
+        chunk = bytearray()
+        for row, schedule in _with_schedules(batch, include_schedule):
+            item = dict(zip(LOAN_FIELDS, row))
+            if schedule is not None:
+                item["schedule"] = [dict(zip(loans.SCHEDULE_FIELDS, month)) for month in schedule]
+            chunk += orjson.dumps(item) + b"\n"
+        yield bytes(chunk)
+
+def iter_export_csv(db: Session, user_id: int, include_schedule: bool = False, batch_size: int = None):
+    '''
+    One CSV row per loan, or per loan-month (loan columns repeated) when include_schedule is set
+    '''
+    header = LOAN_FIELDS + (loans.SCHEDULE_FIELDS if include_schedule else ())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for batch in _loan_batches(db, user_id, batch_size or EXPORT_BATCH_SIZE):
+        for row, schedule in _with_schedules(batch, include_schedule):
+            if schedule is None:
+                writer.writerow(row)
+            else:
+                writer.writerows(tuple(row) + month for month in schedule)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # an empty portfolio still gets its header
+    if buffer.tell():
+        yield buffer.getvalue().encode()
@@ -1,36 +1,196 @@
-from sqlalchemy import Column, Integer, ForeignKey
-from sqlalchemy.orm import Session
+from typing import List
+from sqlalchemy import Column, Integer, ForeignKey, Index, select, exists, delete, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, raiseload
 from database.db import Base
+from model.cache import LRUCache
 from model.loans import Loan
+from model.users import User
+import config
 
 class LoanAccess(Base):
     __tablename__ = "loan_access"
     loan_id = Column(Integer, ForeignKey('loans.id'), primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
 
+    # The primary key covers lookups by loan; listing a user's loans needs (user_id, loan_id)
+    __table_args__ = (Index("ix_loan_access_user_id_loan_id", "user_id", "loan_id"),)
+
+# Optional per-process cache of user_id -> frozenset of accessible loan ids.
+# Off by default (ACCESS_CACHE_SIZE=0) since other processes' shares won't invalidate it,
+# so only turn it on for single-process deployments or with a short ACCESS_CACHE_TTL.
+access_cache = LRUCache(config.ACCESS_CACHE_SIZE, config.ACCESS_CACHE_TTL)
+
+def invalidate_access(user_id: int):
+    access_cache.invalidate(user_id)
+
+def get_accessible_loan_ids(db: Session, user_id: int):
+    '''
+    Set of loan ids the user can see, from the access cache when possible
+    '''
+    loan_ids = access_cache.get(user_id)
+    if loan_ids is None:
+        loan_ids = frozenset(loan_id for (loan_id,) in db.query(LoanAccess.loan_id).filter(LoanAccess.user_id == user_id))
+        access_cache.set(user_id, loan_ids)
+    return loan_ids
+
 def access_check(db: Session, loan_id: int, user_id: int):
     '''
     Check if a user has access to a loan
     Returns True/False
     '''
+    if access_cache.maxsize > 0:
+        return loan_id in get_accessible_loan_ids(db, user_id)
     return db.query(LoanAccess).filter(LoanAccess.loan_id == loan_id, LoanAccess.user_id == user_id).first() is not None
 
+def get_loan_for_user(db: Session, loan_id: int, user_id: int):
+    '''
+    Fetch a loan only if the user has access to it
+    One JOIN query, or just the loan lookup when the access cache already knows the answer
+    Returns the Loan, or None if it doesn't exist or the user can't see it
+    '''
+    if access_cache.maxsize > 0:
+        if loan_id not in get_accessible_loan_ids(db, user_id):
+            return None
+        return db.query(Loan).filter(Loan.id == loan_id).first()
+    return db.query(Loan).join(LoanAccess, LoanAccess.loan_id == Loan.id).filter(
+        LoanAccess.loan_id == loan_id, LoanAccess.user_id == user_id).first()
+
+def _share_check_query(loan_id: int, user_id: int):
+    owner_id = select(Loan.owner_id).where(Loan.id == loan_id).scalar_subquery()
+    user_exists = exists().where(User.id == user_id)
+    return select(owner_id.label("owner_id"), user_exists.label("user_exists"))
+
+def get_share_check(db: Session, loan_id: int, user_id: int):
+    '''
+    Everything share_loan needs to know, in one query
+    Returns (owner_id of the loan or None if it doesn't exist, whether the user exists)
+    '''
+    row = db.execute(_share_check_query(loan_id, user_id)).one()
+    return row.owner_id, row.user_exists
+
+def _insert_access(loan_id: int, user_id: int):
+    # INSERT OR IGNORE, so sharing an already shared loan is a no-op instead of check-then-insert
+    return sqlite_insert(LoanAccess).values(loan_id=loan_id, user_id=user_id).on_conflict_do_nothing()
+
 def add_user(db: Session, loan_id: int, user_id: int):
     '''
     Add access for the user to view the loan
     '''
-    # succeed fast if the user already has access
-    if access_check(db, loan_id, user_id):
-        return True
-
-    db_loan_access = LoanAccess(loan_id=loan_id, user_id=user_id)
-    db.add(db_loan_access)
+    db.execute(_insert_access(loan_id, user_id))
     db.commit()
-    db.refresh(db_loan_access)
+    invalidate_access(user_id)
     return True
 
-def get_loans_by_user_id(db: Session, user_id: int):
+# Listings serialize nothing but Loan columns. Their relationships (owner, users) raise
+# rather than lazy load, so a serializer that starts touching one fails in the query budget
+# tests instead of quietly running a query per row; give it a selectinload here instead.
+LISTING_OPTIONS = (raiseload("*"),)
+
+def get_share_checks(db: Session, loan_ids: List[int], user_ids: List[int]):
+    '''
+    get_share_check for many loans and users, in two queries
+    Returns ({loan_id: owner_id} for the loans that exist, set of user ids that exist)
+    '''
+    owners = dict(db.execute(select(Loan.id, Loan.owner_id).where(Loan.id.in_(loan_ids))).all()) if loan_ids else {}
+    existing = set(db.execute(select(User.id).where(User.id.in_(user_ids))).scalars()) if user_ids else set()
+    return owners, existing
+
+def add_users(db: Session, pairs: List[tuple]):
+    '''
+    Grant access for many (loan_id, user_id) pairs with one INSERT OR IGNORE
+    Returns the number of pairs that didn't already have access
+    '''
+    if not pairs:
+        return 0
+    result = db.execute(sqlite_insert(LoanAccess).on_conflict_do_nothing(),
+                        [{"loan_id": loan_id, "user_id": user_id} for loan_id, user_id in pairs])
+    db.commit()
+    for user_id in {user_id for _, user_id in pairs}:
+        invalidate_access(user_id)
+    return result.rowcount
+
+def remove_users(db: Session, pairs: List[tuple]):
+    '''
+    Revoke access for many (loan_id, user_id) pairs with one DELETE
+    Returns the number of pairs that had access
+    '''
+    if not pairs:
+        return 0
+    result = db.execute(delete(LoanAccess).where(tuple_(LoanAccess.loan_id, LoanAccess.user_id).in_(pairs)))
+    db.commit()
+    for user_id in {user_id for _, user_id in pairs}:
+        invalidate_access(user_id)
+    return result.rowcount
+
+def _loans_by_user_id_query(query, user_id: int, after: int, limit: int):
+    # filter and order on loan_access.loan_id rather than loans.id so the (user_id, loan_id) index does the work
+    query = query.options(*LISTING_OPTIONS).join(LoanAccess, LoanAccess.loan_id == Loan.id).filter(LoanAccess.user_id == user_id)
+    if after is not None:
+        query = query.filter(LoanAccess.loan_id > after)
+    return query.order_by(LoanAccess.loan_id).limit(limit)
+
+def get_loans_by_user_id(db: Session, user_id: int, after: int=None, limit: int=None):
+    '''
+    Get a list of all loans a user has access to, ordered by id
+    after/limit page through them by loan id, no limit returns everything
+    '''
+    return _loans_by_user_id_query(db.query(Loan), user_id, after, limit).all()
+
+def get_loans_by_ids_for_user(db: Session, loan_ids: List[int], user_id: int):
     '''
-    Get a list of all loans a user has access to
+    Fetch every loan in loan_ids that the user has access to, in one query
+    Loans the user can't see (or that don't exist) are left out
     '''
-    return db.query(Loan).join(LoanAccess, LoanAccess.loan_id == Loan.id).filter(LoanAccess.user_id == user_id).all()
\ No newline at end of file
+    if not loan_ids:
+        return []
+    return db.query(Loan).options(*LISTING_OPTIONS).join(LoanAccess, LoanAccess.loan_id == Loan.id).filter(
+        LoanAccess.user_id == user_id, Loan.id.in_(loan_ids)).all()
+
+# async versions, for routes_async.py
+
+async def get_accessible_loan_ids_async(db: AsyncSession, user_id: int):
+    loan_ids = access_cache.get(user_id)
+    if loan_ids is None:
+        result = await db.execute(select(LoanAccess.loan_id).filter(LoanAccess.user_id == user_id))
+        loan_ids = frozenset(result.scalars().all())
+        access_cache.set(user_id, loan_ids)
+    return loan_ids
+
+async def access_check_async(db: AsyncSession, loan_id: int, user_id: int):
+    if access_cache.maxsize > 0:
+        return loan_id in await get_accessible_loan_ids_async(db, user_id)
+    query = select(LoanAccess).filter(LoanAccess.loan_id == loan_id, LoanAccess.user_id == user_id)
+    return (await db.execute(query)).scalars().first() is not None
+
+async def get_loan_for_user_async(db: AsyncSession, loan_id: int, user_id: int):
+    if access_cache.maxsize > 0:
+        if loan_id not in await get_accessible_loan_ids_async(db, user_id):
+            return None
+        query = select(Loan).filter(Loan.id == loan_id)
+    else:
+        query = select(Loan).join(LoanAccess, LoanAccess.loan_id == Loan.id).filter(
+            LoanAccess.loan_id == loan_id, LoanAccess.user_id == user_id)
+    return (await db.execute(query)).scalars().first()
+
+async def get_share_check_async(db: AsyncSession, loan_id: int, user_id: int):
+    row = (await db.execute(_share_check_query(loan_id, user_id))).one()
+    return row.owner_id, row.user_exists
+
+async def add_user_async(db: AsyncSession, loan_id: int, user_id: int):
+    await db.execute(_insert_access(loan_id, user_id))
+    await db.commit()
+    invalidate_access(user_id)
+    return True
+
+async def get_loans_by_user_id_async(db: AsyncSession, user_id: int, after: int=None, limit: int=None):
+    query = _loans_by_user_id_query(select(Loan), user_id, after, limit)
+    return (await db.execute(query)).scalars().all()
+
+async def get_loans_by_ids_for_user_async(db: AsyncSession, loan_ids: List[int], user_id: int):
+    if not loan_ids:
+        return []
+    query = select(Loan).options(*LISTING_OPTIONS).join(LoanAccess, LoanAccess.loan_id == Loan.id).filter(
+        LoanAccess.user_id == user_id, Loan.id.in_(loan_ids))
+    return (await db.execute(query)).scalars().all()
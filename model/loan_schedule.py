@@ -0,0 +1,226 @@
+"""
+Materialized amortization schedules.
+
+With SCHEDULE_STORAGE=materialized, every loan's schedule is written to the
+loan_schedule table whenever the loan is created or its apr/amount/term change,
+in the same transaction, and schedule/summary reads become indexed lookups on
+(loan_id, month) instead of recomputing. Each row also carries the running
+principal/interest totals so a month summary is a single row read.
+
+Existing loans can be filled in, and stored rows checked against the live
+calculator, from the command line:
+
+    $ python -m model.loan_schedule backfill
+    $ python -m model.loan_schedule check
+"""
+import argparse
+import sys
+from typing import List
+import numpy as np
+from sqlalchemy import Column, Integer, Float, ForeignKey, delete, insert, event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from starlette.concurrency import run_in_threadpool
+from database.db import Base
+from model import amortization, loans
+from model.loans import Loan, LoanSchema
+import config
+
+class LoanScheduleRow(Base):
+    __tablename__ = "loan_schedule"
+    loan_id = Column(Integer, ForeignKey("loans.id"), primary_key=True)
+    month = Column(Integer, primary_key=True)
+
+    open_balance = Column(Float)
+    total_payment = Column(Float)
+    principal_payment = Column(Float)
+    interest_payment = Column(Float)
+    close_balance = Column(Float)
+    aggregate_principal_paid = Column(Float)
+    aggregate_interest_paid = Column(Float)
+
+SCHEDULE_COLUMNS = loans.SCHEDULE_FIELDS
+
+def is_materialized():
+    return config.SCHEDULE_STORAGE == "materialized"
+
+def build_rows(loans: List[LoanSchema]):
+    '''
+    loan_schedule rows for every month of every loan, from one vectorized pass
+    '''
+    if not loans:
+        return []
+    schedules = amortization.get_loan_schedules(
+        [loan.apr for loan in loans], [loan.amount for loan in loans], [loan.term for loan in loans])
+    mask = schedules["mask"]
+    aggregate_principal = np.cumsum(np.where(mask, schedules["principal_payment"], 0), axis=1)
+    aggregate_interest = np.cumsum(np.where(mask, schedules["interest_payment"], 0), axis=1)
+
+    rows = []
+    for i, loan in enumerate(loans):
+        term = int(mask[i].sum())
+        columns = [schedules[field][i, :term].tolist() for field in SCHEDULE_COLUMNS]
+        columns.append(aggregate_principal[i, :term].tolist())
+        columns.append(aggregate_interest[i, :term].tolist())
+        for values in zip(*columns):
+            row = dict(zip(SCHEDULE_COLUMNS + ("aggregate_principal_paid", "aggregate_interest_paid"), values))
+            row["loan_id"] = loan.id
+            rows.append(row)
+    return rows
+
+def write_schedules(connection, loans: List[LoanSchema]):
+    '''
+    Replace the stored schedules for these loans
+    Runs on the caller's connection and doesn't commit, so it lands in the caller's transaction
+    '''
+    if not loans:
+        return
+    connection.execute(delete(LoanScheduleRow).where(LoanScheduleRow.loan_id.in_([loan.id for loan in loans])))
+    rows = build_rows(loans)
+    if rows:
+        connection.execute(insert(LoanScheduleRow), rows)
+
+_SCHEDULE_FIELDS = ("apr", "amount", "term")
+
+@event.listens_for(Session, "after_flush")
+def _write_changed_schedules(session, flush_context):
+    # Catches every ORM write of a loan (create_loan, update_loan and their async twins)
+    # while the flush's transaction is still open. Bulk paths that skip the ORM call
+    # write_schedules themselves.
+    if not is_materialized():
+        return
+    changed = [obj for obj in session.new if isinstance(obj, Loan)]
+    for obj in session.dirty:
+        if isinstance(obj, Loan) and any(get_history(obj, field).has_changes() for field in _SCHEDULE_FIELDS):
+            changed.append(obj)
+    write_schedules(session.connection(), changed)
+
+def _schedule_query(loan_id: int, from_month: int, to_month: int):
+    columns = [getattr(LoanScheduleRow, column) for column in SCHEDULE_COLUMNS]
+    return select(*columns).where(
+        LoanScheduleRow.loan_id == loan_id, LoanScheduleRow.month.between(from_month, to_month)
+    ).order_by(LoanScheduleRow.month)
+
+def _summary_row(row: LoanScheduleRow):
+    return {
+        "current_principal": row.close_balance,
+        "aggregate_principal_paid": row.aggregate_principal_paid,
+        "aggregate_interest_paid": row.aggregate_interest_paid,
+    }
+
+def get_schedule_for_loan(db: Session, loan: LoanSchema, from_month: int = 1, to_month: int = None):
+    '''
+    Schedule rows (tuples in loans.SCHEDULE_FIELDS order) from loan_schedule in materialized
+    mode, otherwise (or if the loan hasn't been backfilled yet) from the live calculator
+    '''
+    if is_materialized():
+        to = to_month if to_month is not None else loan.term
+        rows = db.execute(_schedule_query(loan.id, from_month, to)).all()
+        if rows:
+            return [tuple(row) for row in rows]
+    return loans.get_loan_schedule_for_loan(loan, from_month, to_month)
+
+def get_summary_for_loan(db: Session, loan: LoanSchema, month: int):
+    '''
+    Month summary from a single loan_schedule row in materialized mode, otherwise live
+    Raises ValueError for months outside the loan's term, like loans.get_loan_summary
+    '''
+    if is_materialized() and 0 < month <= loan.term:
+        row = db.get(LoanScheduleRow, (loan.id, month))
+        if row:
+            return _summary_row(row)
+    return loans.get_loan_summary_for_loan(loan, month)
+
+async def get_schedule_for_loan_async(db: AsyncSession, loan: LoanSchema, from_month: int = 1, to_month: int = None):
+    if is_materialized():
+        to = to_month if to_month is not None else loan.term
+        rows = (await db.execute(_schedule_query(loan.id, from_month, to))).all()
+        if rows:
+            return [tuple(row) for row in rows]
+    # the math is CPU bound, keep it off the event loop
+    return await run_in_threadpool(loans.get_loan_schedule_for_loan, loan, from_month, to_month)
+
+async def get_summary_for_loan_async(db: AsyncSession, loan: LoanSchema, month: int):
+    if is_materialized() and 0 < month <= loan.term:
+        row = await db.get(LoanScheduleRow, (loan.id, month))
+        if row:
+            return _summary_row(row)
+    return loans.get_loan_summary_for_loan(loan, month)
+
+def backfill(db: Session, batch_size: int = 500, only_missing: bool = True):
+    '''
+    Write stored schedules for existing loans, committing every batch_size loans
+    Returns the number of loans written
+    '''
+    query = db.query(Loan).order_by(Loan.id)
+    if only_missing:
+        stored = select(LoanScheduleRow.loan_id).distinct()
+        query = query.filter(Loan.id.not_in(stored))
+
+    written = 0
+    after = 0
+    while True:
+        batch = query.filter(Loan.id > after).limit(batch_size).all()
+        if not batch:
+            return written
+        write_schedules(db.connection(), batch)
+        db.commit()
+        written += len(batch)
+        after = batch[-1].id
+
+def check_consistency(db: Session, batch_size: int = 500):
+    '''
+    Compare every stored schedule with the live calculator
+    Returns a list of (loan_id, problem) tuples, empty when everything matches
+    '''
+    problems = []
+    after = 0
+    while True:
+        batch = db.query(Loan).filter(Loan.id > after).order_by(Loan.id).limit(batch_size).all()
+        if not batch:
+            return problems
+        after = batch[-1].id
+        stored = {}
+        for row in db.query(LoanScheduleRow).filter(LoanScheduleRow.loan_id.in_([loan.id for loan in batch])):
+            stored.setdefault(row.loan_id, {})[row.month] = row
+
+        for loan in batch:
+            rows = stored.get(loan.id, {})
+            if sorted(rows) != list(range(1, loan.term + 1)):
+                problems.append((loan.id, "stored months don't match term %d (%d rows)" % (loan.term, len(rows))))
+                continue
+            tolerance = loan.amount * loans.SUMMARY_TOLERANCE
+            principal = interest = 0
+            for expected in loans.get_loan_schedule(loan.apr, loan.amount, loan.term):
+                row = rows[expected.month]
+                principal += expected.principal_payment
+                interest += expected.interest_payment
+                values = dict(expected.dict(), aggregate_principal_paid=principal, aggregate_interest_paid=interest)
+                bad = [field for field, value in values.items() if abs(getattr(row, field) - value) > tolerance]
+                if bad:
+                    problems.append((loan.id, "month %d differs in %s" % (expected.month, ", ".join(bad))))
+                    break
+
+def main():
+    from database.db import SessionLocal, engine
+
+    parser = argparse.ArgumentParser(description="Backfill or check materialized loan schedules")
+    parser.add_argument("command", choices=["backfill", "check"])
+    parser.add_argument("--all", action="store_true", help="backfill: rewrite every loan, not just ones without rows")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    with SessionLocal() as db:
+        if args.command == "backfill":
+            print("wrote schedules for %d loans" % backfill(db, args.batch_size, only_missing=not args.all))
+        else:
+            problems = check_consistency(db, args.batch_size)
+            for loan_id, problem in problems:
+                print("loan %d: %s" % (loan_id, problem))
+            print("%d loans with problems" % len(set(loan_id for loan_id, _ in problems)))
+            sys.exit(1 if problems else 0)
+
+if __name__ == "__main__":
+    main()
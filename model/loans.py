@@ -1,8 +1,16 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float
+from typing import List, Optional
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, DateTime, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship, Session
 from database.db import Base
 from pydantic import BaseModel
 from fastapi import HTTPException
+from model import amortization
+from model.cache import LRUCache
+import config
+import metrics
+import orjson
 
 class Loan(Base):
     __tablename__ = "loans"
@@ -16,6 +24,9 @@ class Loan(Base):
     term : int = Column(Integer)
     status : str = Column(String)
     owner_id : int = Column(Integer, ForeignKey("users.id"))
+    # Bumped on every update, for ETag/Last-Modified on schedule and summary reads
+    version : int = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at : datetime = Column(DateTime, default=datetime.utcnow)
 
     owner = relationship("User", back_populates="loans")
     users = relationship("User", secondary="loan_access", back_populates="shared_loans")
@@ -41,11 +52,51 @@ class LoanScheduleSchema(BaseModel):
     interest_payment: float
     close_balance: float
 
+class LoanBatchScheduleSchema(BaseModel):
+    loan_id: int
+    schedule: List[LoanScheduleSchema]
+
 class LoanSummarySchema(BaseModel):
     current_principal: float
     aggregate_principal_paid: float
     aggregate_interest_paid: float
 
+class PortfolioLoanSchema(LoanSummarySchema):
+    loan_id: int
+    month: int
+    amount: float
+    apr: float
+    term: int
+
+class PortfolioTotalsSchema(LoanSummarySchema):
+    loan_count: int
+    amount: float
+
+class PortfolioSchema(BaseModel):
+    user_id: int
+    month: int
+    loans: List[PortfolioLoanSchema]
+    totals: PortfolioTotalsSchema
+
+class LoanScenarioSchema(BaseModel):
+    month: int
+    extra_payment: float = 0
+    apr: Optional[float] = None
+
+class LoanScenarioResultSchema(BaseModel):
+    month: int
+    extra_payment: float
+    apr: float
+    balance: float
+    monthly_payment: float
+    total_interest: float
+    interest_saved: float
+    schedule: Optional[List[LoanScheduleSchema]] = None
+
+MAX_SCENARIOS = 1000
+# schedules:batch builds loans x longest-term arrays, then a dict per cell
+MAX_BATCH_LOANS = 500
+
 def validateLoan(loan: LoanSchemaBase):
     '''
     Validate the input data for loan creation
@@ -87,19 +138,43 @@ def get_loan_by_id(db: Session, id: int):
 def get_loans_by_owner_id(db: Session, owner_id: int, skip: int=0, limit: int=100):
     return db.query(Loan).filter(Loan.owner_id == owner_id).offset(skip).limit(limit).all()
 
-def update_loan(db: Session, loan: Loan, loanData: LoanSchemaBase):
+def _apply_update(loan: Loan, loanData: LoanSchemaBase):
+    invalidate_cached_schedule(loan)
     loan.amount = loanData.amount
     loan.apr = loanData.apr
     loan.term = loanData.term
     loan.status = loanData.status
     loan.owner_id = loanData.owner_id
+    loan.version = Loan.version + 1
+    loan.updated_at = datetime.utcnow()
+
+def update_loan(db: Session, loan: Loan, loanData: LoanSchemaBase):
+    _apply_update(loan, loanData)
     db.commit()
     db.refresh(loan)
     return loan
 
+# async versions, for routes_async.py
+
+async def create_loan_async(db: AsyncSession, loanData: LoanSchemaBase):
+    loan = Loan(**loanData.dict())
+    db.add(loan)
+    await db.commit()
+    await db.refresh(loan)
+    return loan
+
+async def get_loan_by_id_async(db: AsyncSession, id: int):
+    return (await db.execute(select(Loan).filter(Loan.id == id))).scalars().first()
+
+async def update_loan_async(db: AsyncSession, loan: Loan, loanData: LoanSchemaBase):
+    _apply_update(loan, loanData)
+    await db.commit()
+    await db.refresh(loan)
+    return loan
+
 # https://www.investopedia.com/terms/a/amortization_schedule.asp
-# TODO: add some DP/caching to these? may get called often for the same params
-# but Zac says scale is not a priority, so let's not prematurely optimize
+# These get called often for the same params, so the *_for_loan helpers below
+# go through an LRU cache keyed by (apr, amount, term). See config.LOAN_CACHE_*
 def calc_monthly_total_payment(apr: float, balance: float, term: int):
     temp_val = ((apr / 12) + 1) ** term
     return balance * ((apr / 12 * temp_val) / (temp_val - 1))
@@ -110,15 +185,90 @@ def calc_monthly_interest(apr: float, balance: float):
 def calc_monthly_principal_payment(apr: float, balance: float, term: int):
     return calc_monthly_total_payment(apr, balance, term) - calc_monthly_interest(apr, balance)
 
-def get_loan_schedule_for_loan(loan: LoanSchema):
-    return get_loan_schedule(loan.apr, loan.amount, loan.term)
+SCHEDULE_FIELDS = amortization.SCHEDULE_FIELDS
+
+# Closed-form versions of the running totals in get_loan_schedule.
+# After k payments of P at monthly rate r, the balance is A(1+r)^k - P((1+r)^k - 1)/r.
+# Float error vs. summing the schedule month by month stays below 1e-9 of the amount
+# (a fraction of a cent on a $10M loan) for terms up to 40 years.
+SUMMARY_TOLERANCE = 1e-9
+
+def calc_remaining_balance(apr: float, amount: float, term: int, month: int):
+    if month == 0:
+        return amount
+    monthly_rate = apr / 12
+    growth = (monthly_rate + 1) ** month
+    monthly_payment = calc_monthly_total_payment(apr, amount, term)
+    return amount * growth - monthly_payment * (growth - 1) / monthly_rate
+
+def calc_cumulative_principal(apr: float, amount: float, term: int, month: int):
+    return amount - calc_remaining_balance(apr, amount, term, month)
 
-def get_loan_schedule(apr: float, amount: float, term: int):
-    schedule = []
+def calc_cumulative_interest(apr: float, amount: float, term: int, month: int):
+    # every payment is the same size, so whatever didn't go to principal went to interest
     monthly_payment = calc_monthly_total_payment(apr, amount, term)
-    principal = amount
+    return month * monthly_payment - calc_cumulative_principal(apr, amount, term, month)
+
+# Schedules are cached whole; summaries are cached as a {month: summary} dict per loan,
+# so one invalidation drops every month, but hits and misses are counted per month
+schedule_cache = LRUCache(config.LOAN_CACHE_SIZE, config.LOAN_CACHE_TTL)
+summary_cache = LRUCache(config.LOAN_CACHE_SIZE, config.LOAN_CACHE_TTL)
+
+def _cache_key(loan: LoanSchema):
+    return (loan.apr, loan.amount, loan.term)
+
+def invalidate_cached_schedule(loan: LoanSchema):
+    '''
+    Drop the cached schedule and summaries for the loan's current params
+    Call this before changing apr, amount or term
+    '''
+    key = _cache_key(loan)
+    schedule_cache.invalidate(key)
+    summary_cache.invalidate(key)
+
+def cache_stats():
+    return {"schedule": schedule_cache.stats(), "summary": summary_cache.stats()}
+
+@metrics.track_amortization
+def get_loan_schedule_for_loan(loan: LoanSchema, from_month: int = 1, to_month: int = None):
+    # Only the full schedule is cached, slices are cheap to compute directly
+    if from_month != 1 or (to_month is not None and to_month != loan.term):
+        return get_loan_schedule_rows(loan.apr, loan.amount, loan.term, from_month, to_month)
+
+    # The cached list is shared between callers, so don't mutate it
+    key = _cache_key(loan)
+    schedule = schedule_cache.get(key)
+    if schedule is None:
+        schedule = get_loan_schedule_rows(loan.apr, loan.amount, loan.term)
+        schedule_cache.set(key, schedule)
+    return schedule
 
-    for month in range(1, term + 1):
+def get_loan_schedule(apr: float, amount: float, term: int, from_month: int = 1, to_month: int = None):
+    return list(iter_loan_schedule(apr, amount, term, from_month, to_month))
+
+def iter_loan_schedule(apr: float, amount: float, term: int, from_month: int = 1, to_month: int = None):
+    for row in iter_loan_schedule_rows(apr, amount, term, from_month, to_month):
+        yield LoanScheduleSchema(**dict(zip(SCHEDULE_FIELDS, row)))
+
+def get_loan_schedule_rows(apr: float, amount: float, term: int, from_month: int = 1, to_month: int = None):
+    return list(iter_loan_schedule_rows(apr, amount, term, from_month, to_month))
+
+def iter_loan_schedule_rows(apr: float, amount: float, term: int, from_month: int = 1, to_month: int = None):
+    """
+    Lazily generates schedule rows for months from_month..to_month (inclusive),
+    as plain tuples in SCHEDULE_FIELDS order. The routes encode these straight to JSON,
+    get_loan_schedule wraps them in LoanScheduleSchema for everyone else.
+    The opening balance for from_month comes from the closed form, so a slice
+    near the end of a long loan doesn't walk through every earlier month.
+    """
+    if to_month is None:
+        to_month = term
+    validate_month_range(term, from_month, to_month)
+
+    monthly_payment = calc_monthly_total_payment(apr, amount, term)
+    principal = calc_remaining_balance(apr, amount, term, from_month - 1)
+
+    for month in range(from_month, to_month + 1):
 
         interest_amount = calc_monthly_interest(apr, principal)
         principal_payment = monthly_payment - interest_amount
@@ -127,38 +277,132 @@ def get_loan_schedule(apr: float, amount: float, term: int):
         principal -= principal_payment
         close_balance = principal
 
-        schedule.append(LoanScheduleSchema(
-            month=month, open_balance=open_balance, close_balance=close_balance, total_payment=monthly_payment,
-            principal_payment=principal_payment, interest_payment=interest_amount)
-        )
+        yield (month, open_balance, monthly_payment, principal_payment, interest_amount, close_balance)
 
-    return schedule
+def validate_month(term: int, month: int):
+    if month < 0:
+        raise ValueError("Month must be greater than or equal to zero")
+    if month > term:
+        raise ValueError("Month must be less than or equal to the loan term")
 
+def validate_month_range(term: int, from_month: int, to_month: int):
+    if from_month < 1:
+        raise ValueError("from_month must be greater than or equal to one")
+    if to_month > term:
+        raise ValueError("to_month must be less than or equal to the loan term")
+    if from_month > to_month:
+        raise ValueError("from_month must be less than or equal to to_month")
+
+@metrics.track_amortization
 def get_loan_summary_for_loan(loan: LoanSchema, month: int):
-    return get_loan_summary(loan.apr, loan.amount, loan.term, month)
+    key = _cache_key(loan)
+    summaries = summary_cache.get(key, record=False)
+    if summaries is None:
+        summaries = {}
+        summary_cache.set(key, summaries)
+    summary_cache.record_lookup(month in summaries)
+    if month not in summaries:
+        summaries[month] = get_loan_summary(loan.apr, loan.amount, loan.term, month)
+    return dict(summaries[month])
+
+# Fast path for schedule responses: rows stay tuples until orjson encodes them, instead of
+# building a LoanScheduleSchema per month and having FastAPI validate it all again
+
+def schedule_to_json(rows: list):
+    return orjson.dumps([dict(zip(SCHEDULE_FIELDS, row)) for row in rows])
+
+def schedule_to_columnar_json(rows: list):
+    """
+    One array per field, e.g. {"month": [1, 2, ...], "open_balance": [...], ...}
+    Drops the repeated keys, which is most of the row format's size
+    """
+    columns = zip(*rows) if rows else [()] * len(SCHEDULE_FIELDS)
+    return orjson.dumps(dict(zip(SCHEDULE_FIELDS, map(list, columns))))
+
+def iter_loan_schedule_ndjson(loan: LoanSchema, from_month: int = 1, to_month: int = None):
+    """
+    Newline-delimited JSON schedule rows, produced one at a time for StreamingResponse
+    The loan's fields are read right away, so the generator doesn't touch the ORM object
+    after the session is gone
+    """
+    rows = iter_loan_schedule_rows(loan.apr, loan.amount, loan.term, from_month, to_month)
+    return (orjson.dumps(dict(zip(SCHEDULE_FIELDS, row))) + b"\n" for row in rows)
 
 def get_loan_summary(apr: float, amount: float, term: int, month: int):
     """
     Generates a summary of the loan for the given month.
     Month 0 is the initial state of the loan, Month 1 is after the first payment.
+
+    Uses the closed-form annuity formulas, so this is O(1) in the term instead of
+    building the whole schedule. Matches the iterative schedule sums to within
+    SUMMARY_TOLERANCE * amount.
     """
-    total_interest = 0
-    total_principal = 0
-    current_principal = amount
+    validate_month(term, month)
 
-    if month < 0:
-        raise ValueError("Month must be greater than or equal to zero")
-    if month > term:
-        raise ValueError("Month must be less than or equal to the loan term")
-    if month > 0:
-        schedule = get_loan_schedule(apr, amount, term)
-        for i in range (0, month):
-            total_interest += schedule[i].interest_payment
-            total_principal += schedule[i].principal_payment
-            current_principal = schedule[i].close_balance
+    current_principal = calc_remaining_balance(apr, amount, term, month)
+    total_principal = amount - current_principal
+    total_interest = calc_cumulative_interest(apr, amount, term, month)
     return {
         "current_principal": current_principal,
         "aggregate_principal_paid": total_principal,
         "aggregate_interest_paid": total_interest
     }
 
+@metrics.track_amortization
+def get_loan_schedules_for_loans(loans: List[LoanSchema]):
+    """
+    Schedules for a batch of loans, computed in one vectorized pass
+    Returns a list of {"loan_id", "schedule"} dicts in the same order as loans
+    (already plain data, so routes can hand it to orjson without a response_model pass)
+    """
+    schedules = amortization.get_loan_schedules(
+        [loan.apr for loan in loans], [loan.amount for loan in loans], [loan.term for loan in loans])
+    return [
+        {"loan_id": loan.id, "schedule": amortization.schedule_rows(schedules, i)}
+        for i, loan in enumerate(loans)
+    ]
+
+@metrics.track_amortization
+def get_portfolio_summary(loans: List[LoanSchema], month: int):
+    """
+    Summaries for every loan at the given month, plus totals, in one vectorized pass
+    Loans shorter than month are reported at their final month (paid off)
+    """
+    if month < 0:
+        raise ValueError("Month must be greater than or equal to zero")
+
+    months = [min(month, loan.term) for loan in loans]
+    summaries = amortization.get_loan_summaries(
+        [loan.apr for loan in loans], [loan.amount for loan in loans], [loan.term for loan in loans], months)
+    fields = ("current_principal", "aggregate_principal_paid", "aggregate_interest_paid")
+    columns = {field: summaries[field].tolist() for field in fields}
+
+    rows = [
+        dict({field: columns[field][i] for field in fields},
+             loan_id=loan.id, month=months[i], amount=loan.amount, apr=loan.apr, term=loan.term)
+        for i, loan in enumerate(loans)
+    ]
+    totals = {field: float(summaries[field].sum()) for field in fields}
+    totals.update(loan_count=len(loans), amount=sum(loan.amount for loan in loans))
+    return {"loans": rows, "totals": totals}
+
+@metrics.track_amortization
+def get_loan_scenarios(loan: LoanSchema, scenarios: List[LoanScenarioSchema], include_schedule: bool = False):
+    """
+    What-if results for paying extra and/or repricing the loan from a given month,
+    all scenarios in one vectorized pass (see amortization.get_scenarios)
+    A scenario without an apr keeps the loan's. Raises ValueError for invalid scenarios.
+    """
+    results = amortization.get_scenarios(
+        loan.apr, loan.amount, loan.term,
+        [scenario.month for scenario in scenarios],
+        [scenario.extra_payment for scenario in scenarios],
+        [loan.apr if scenario.apr is None else scenario.apr for scenario in scenarios],
+        include_schedules=include_schedule)
+    fields = ("month", "extra_payment", "apr", "balance", "monthly_payment", "total_interest", "interest_saved")
+    columns = {field: results[field].tolist() for field in fields}
+    rows = [{field: columns[field][i] for field in fields} for i in range(len(scenarios))]
+    if include_schedule:
+        for i, row in enumerate(rows):
+            row["schedule"] = amortization.schedule_rows(results["schedules"], i)
+    return rows
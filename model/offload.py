@@ -0,0 +1,104 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+from fastapi import HTTPException
+from model.loans import Loan, LoanSchema
+import config
+import metrics
+
+# Process pool for big amortization jobs. The schedule math is pure Python (or NumPy
+# glue around it) and holds the GIL, so one large batch or portfolio request can stall
+# every other request in the worker. Jobs above config.AMORTIZATION_OFFLOAD_THRESHOLD
+# loan-months run in a pool of AMORTIZATION_WORKERS processes instead; smaller ones
+# keep running inline, where they're cheaper than the pickling round trip.
+#
+# At most AMORTIZATION_MAX_JOBS jobs are in the pool at once and up to
+# AMORTIZATION_MAX_QUEUED more wait for a slot (amortization_pool_queued_jobs in /metrics).
+# Both running and waiting jobs hold a threadpool thread, so jobs past the queue limit
+# are turned away with a 503 rather than left to take every thread and starve small requests.
+
+_executor = None
+_slots = None
+_queued = 0
+_lock = Lock()
+
+def is_enabled():
+    return config.AMORTIZATION_WORKERS > 0
+
+def _pool():
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            # spawn rather than fork: the parent has DB connections and threadpool threads
+            _executor = ProcessPoolExecutor(config.AMORTIZATION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+            _slots = BoundedSemaphore(config.AMORTIZATION_MAX_JOBS or config.AMORTIZATION_WORKERS)
+        return _executor, _slots
+
+def shutdown():
+    global _executor, _slots, _queued
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown()
+        _executor = _slots = None
+        _queued = 0
+
+def _acquire(slots: BoundedSemaphore):
+    '''
+    Take a pool slot, waiting for one if fewer than AMORTIZATION_MAX_QUEUED jobs already are
+    Returns False, without a slot, if the queue is full
+    '''
+    global _queued
+    if slots.acquire(blocking=False):
+        return True
+    with _lock:
+        if _queued >= (config.AMORTIZATION_MAX_QUEUED or config.AMORTIZATION_WORKERS):
+            return False
+        _queued += 1
+    try:
+        return slots.acquire()
+    finally:
+        with _lock:
+            _queued -= 1
+
+def _picklable(arg):
+    # ORM rows carry session state the workers can't use, they only need the column values
+    if isinstance(arg, Loan):
+        return LoanSchema.from_orm(arg)
+    if isinstance(arg, list):
+        return [LoanSchema.from_orm(item) if isinstance(item, Loan) else item for item in arg]
+    return arg
+
+def run(fn, *args, size: int):
+    '''
+    fn(*args), in the process pool if the pool is on and size (loan-months of work) is
+    at least the offload threshold, otherwise inline. Blocks until the result is ready,
+    so call it from a sync route or run_in_threadpool, not on the event loop.
+    Raises a 503 HTTPException if the pool's queue is full.
+    fn must be a module level function; Loan rows (alone or in lists) are sent as LoanSchema
+    '''
+    if not is_enabled() or size < config.AMORTIZATION_OFFLOAD_THRESHOLD:
+        metrics.amortization_jobs.inc((fn.__name__, "inline"))
+        return fn(*args)
+
+    executor, slots = _pool()
+    metrics.amortization_pool_queued.inc()
+    start = time.perf_counter()
+    acquired = _acquire(slots)
+    metrics.amortization_pool_queued.dec()
+    metrics.amortization_jobs.inc((fn.__name__, "pool" if acquired else "rejected"))
+    if not acquired:
+        raise HTTPException(status_code=503, detail="Too many amortization jobs queued, try again later")
+    try:
+        waited = time.perf_counter() - start
+        metrics.amortization_pool_running.inc()
+        metrics.amortization_pool_wait_seconds.observe(waited)
+        try:
+            return executor.submit(fn, *map(_picklable, args)).result()
+        finally:
+            # the worker's own timing stays in the worker, so record the round trip here
+            elapsed = time.perf_counter() - start - waited
+            metrics.amortization_pool_running.dec()
+            metrics.amortization_seconds.observe(elapsed, (fn.__name__,))
+    finally:
+        slots.release()
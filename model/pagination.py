@@ -0,0 +1,29 @@
+from fastapi import HTTPException, Response
+
+# Keyset (cursor) pagination on id: each page asks for rows with id > after,
+# ordered by id, so deep pages cost the same as the first one (unlike OFFSET).
+# The cursor for the next page goes in a header so the response body stays a plain list.
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def validate_page_size(limit: int):
+    '''
+    Returns:
+        HTTPException if the limit is out of range
+        None otherwise
+    '''
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        return HTTPException(status_code=400, detail="limit must be between 1 and %d" % MAX_PAGE_SIZE)
+    return None
+
+def paginate(rows: list, limit: int, response: Response):
+    '''
+    Trim a page fetched with limit + 1 rows back to limit,
+    and set the next cursor header if there was an extra row
+    '''
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = str(rows[-1].id)
+    return rows
@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String
-from sqlalchemy.orm import relationship, Session
+from sqlalchemy import Column, Integer, String, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import relationship, raiseload, Session
 from database.db import Base
 from pydantic import BaseModel
 from fastapi import HTTPException
@@ -45,5 +46,30 @@ def create_user(db: Session, userData: UserSchemaBase):
 def get_user_by_id(db: Session, id: int):
     return db.query(User).filter(User.id == id).first()
 
-def get_users(db: Session, skip: int=0, limit: int=100):
-    return db.query(User).offset(skip).limit(limit).all()
\ No newline at end of file
+def get_users(db: Session, after: int=None, limit: int=100):
+    '''
+    Page of users ordered by id, starting after the user id in after
+    Relationships raise instead of lazy loading, so nothing can N+1 over the page
+    '''
+    query = db.query(User).options(raiseload("*")).order_by(User.id)
+    if after is not None:
+        query = query.filter(User.id > after)
+    return query.limit(limit).all()
+
+# async versions, for routes_async.py
+
+async def create_user_async(db: AsyncSession, userData: UserSchemaBase):
+    db_user = User(**userData.dict())
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user
+
+async def get_user_by_id_async(db: AsyncSession, id: int):
+    return (await db.execute(select(User).filter(User.id == id))).scalars().first()
+
+async def get_users_async(db: AsyncSession, after: int=None, limit: int=100):
+    query = select(User).options(raiseload("*")).order_by(User.id)
+    if after is not None:
+        query = query.filter(User.id > after)
+    return (await db.execute(query.limit(limit))).scalars().all()
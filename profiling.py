@@ -0,0 +1,234 @@
+import cProfile
+import pstats
+import time
+import uuid
+from contextvars import ContextVar
+from functools import partial
+from threading import Lock
+import fastapi.dependencies.utils
+import fastapi.routing
+from fastapi import APIRouter, HTTPException
+from model.cache import LRUCache
+import config
+
+# Opt-in per-request profiling. With PROFILING_ENABLED=1, a request carrying an
+# "X-Profile: 1" header runs under cProfile and its report is kept in memory, retrievable
+# at GET /profiles/{profile_id} using the X-Profile-Id response header. With it off
+# (the default) install() is never called: no middleware, no routes, nothing patched.
+#
+# cProfile only sees the thread it's enabled on, and sync routes and dependencies run in
+# the threadpool, so install() also wraps FastAPI's run_in_threadpool: while a profiled
+# request is in flight, each threadpool call it makes runs under its own profiler, and
+# those segments are merged with the event loop's into one pstats report. On the event
+# loop the profiler is only on while the profiled request's own task is running (see
+# _Stepped), so other requests' coroutines interleaved with it aren't counted; tasks it
+# spawns itself, like a StreamingResponse's body, aren't either. Only one request is
+# profiled at a time to bound the overhead; concurrent X-Profile requests are served
+# unprofiled.
+
+PROFILE_HEADER = "x-profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+TOP_FUNCTIONS = 25
+CATEGORIES = ("sqlalchemy", "amortization", "serialization", "other")
+
+reports = LRUCache(config.PROFILE_STORE_SIZE)
+
+_session: ContextVar = ContextVar("profile_session", default=None)
+_active = Lock()
+
+class ProfileSession:
+    def __init__(self):
+        self.profiles = []
+        self._lock = Lock()
+
+    def run(self, fn, *args, **kwargs):
+        '''
+        fn(*args, **kwargs) on this thread, profiled into this session
+        '''
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                self.profiles.append(profile)
+
+    def stats(self):
+        with self._lock:
+            stats = pstats.Stats(self.profiles[0])
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+        return stats
+
+# Classification
+
+def _category(filename: str, function: str):
+    '''
+    Category of the time spent inside a function itself, or None for a C builtin whose
+    time should be charged to whatever called it
+    '''
+    if filename == "~":
+        if "sqlite3" in function:
+            return "sqlalchemy"
+        if "orjson" in function or "json" in function:
+            return "serialization"
+        return None
+    path = filename.replace("\\", "/")
+    if "/sqlalchemy/" in path or "/aiosqlite/" in path or "/sqlite3/" in path:
+        return "sqlalchemy"
+    if path.endswith(("model/loans.py", "model/amortization.py")) or "/numpy/" in path:
+        return "amortization"
+    # pydantic is compiled, so its validation shows up as time in FastAPI's response helpers
+    if ("/pydantic/" in path or "/json/" in path or path.endswith(("fastapi/encoders.py", "starlette/responses.py"))
+            or function in ("serialize_response", "_prepare_response_content")):
+        return "serialization"
+    return "other"
+
+def categorize(stats: pstats.Stats):
+    '''
+    Seconds of own (tottime) time per category; builtins are split between their callers
+    '''
+    totals = dict.fromkeys(CATEGORIES, 0.0)
+    for (filename, line, function), (_, _, tottime, _, callers) in stats.stats.items():
+        category = _category(filename, function)
+        if category is not None:
+            totals[category] += tottime
+            continue
+        if not callers:
+            totals["other"] += tottime
+            continue
+        for (caller_file, _, caller_function), caller_stats in callers.items():
+            totals[_category(caller_file, caller_function) or "other"] += caller_stats[2]
+    return {category: round(seconds, 6) for category, seconds in totals.items()}
+
+def build_report(stats: pstats.Stats, **meta):
+    top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return dict(
+        meta,
+        profiled_seconds=round(stats.total_tt, 6),
+        categories=categorize(stats),
+        top=[{
+            "function": "%s:%d(%s)" % (filename, line, function),
+            "calls": calls,
+            "own_seconds": round(tottime, 6),
+            "cumulative_seconds": round(cumtime, 6),
+        } for (filename, line, function), (_, calls, tottime, cumtime, _) in top],
+    )
+
+# Hooks
+
+_original_run_in_threadpool = fastapi.routing.run_in_threadpool
+
+async def _run_in_threadpool(fn, *args, **kwargs):
+    session = _session.get()
+    if session is not None:
+        return await _original_run_in_threadpool(partial(session.run, fn), *args, **kwargs)
+    return await _original_run_in_threadpool(fn, *args, **kwargs)
+
+class _Stepped:
+    '''
+    Awaitable that drives coro one step at a time, with profile enabled only during
+    each step, so whatever else the event loop runs between steps isn't profiled
+    '''
+    def __init__(self, coro, profile: cProfile.Profile):
+        self.coro = coro
+        self.profile = profile
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            self.profile.enable()
+            try:
+                yielded = self.coro.throw(error) if error is not None else self.coro.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.profile.disable()
+            try:
+                value, error = (yield yielded), None
+            except GeneratorExit:
+                self.coro.close()
+                raise
+            except BaseException as e:
+                value, error = None, e
+
+class ProfilingMiddleware:
+    '''
+    Profiles requests that ask for it with the X-Profile header and stores the report
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or dict(scope["headers"]).get(PROFILE_HEADER.encode()) != b"1":
+            return await self.app(scope, receive, send)
+        if not _active.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+
+        profile_id = uuid.uuid4().hex
+        status = [500]
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (PROFILE_ID_HEADER.lower().encode(), profile_id.encode())]
+            await send(message)
+
+        session = ProfileSession()
+        token = _session.set(session)
+        loop_profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            await _Stepped(self.app(scope, receive, send_with_profile_id), loop_profile)
+        finally:
+            wall = time.perf_counter() - start
+            _session.reset(token)
+            _active.release()
+            session.profiles.append(loop_profile)
+            reports.set(profile_id, build_report(
+                session.stats(), id=profile_id, method=scope["method"], path=scope["path"],
+                query=scope["query_string"].decode(), status=status[0], wall_seconds=round(wall, 6),
+                segments=len(session.profiles)))
+
+def get_report(profile_id: str):
+    return reports.get(profile_id)
+
+def list_reports():
+    '''
+    Summaries of the stored reports, most recently used last
+    '''
+    return [{field: report[field] for field in ("id", "method", "path", "status", "wall_seconds")} for report in reports.values()]
+
+# Routes, only included by install()
+
+router = APIRouter()
+
+@router.get("/profiles")
+def list_profiles():
+    """
+    Stored request profiles (PROFILING_ENABLED=1 and an "X-Profile: 1" request header)
+    """
+    return list_reports()
+
+@router.get("/profiles/{profile_id}")
+def get_profile(profile_id: str):
+    """
+    One request's profile: time by category (sqlalchemy, amortization, serialization,
+    other) and the functions with the most cumulative time
+    """
+    report = get_report(profile_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile %s not found" % profile_id )
+    return report
+
+def install(app):
+    '''
+    Turn on profiling for app: add the middleware and the /profiles routes, and route
+    FastAPI's threadpool calls through _run_in_threadpool
+    '''
+    fastapi.routing.run_in_threadpool = _run_in_threadpool
+    fastapi.dependencies.utils.run_in_threadpool = _run_in_threadpool
+    app.add_middleware(ProfilingMiddleware)
+    app.include_router(router)
@@ -0,0 +1,159 @@
+import orjson
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from typing import List, Optional
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.db import AsyncSessionLocal
+from model import loans, users, loan_access, loan_schedule, pagination, conditional, offload
+
+# AsyncSession versions of the routes in main.py, enabled with DB_MODE=async.
+# main.py includes this router ahead of its own routes, so these take precedence
+# and anything without an async version here falls through to the sync route.
+# They're left out of the OpenAPI schema since the sync routes already document them.
+router = APIRouter(include_in_schema=False)
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+@router.post("/users", response_model=users.UserSchema)
+async def create_user(userData: users.UserSchemaBase, db: AsyncSession = Depends(get_async_db)):
+    err = users.validate_user(userData)
+    if err:
+        raise err
+
+    return await users.create_user_async(db=db, userData=userData)
+
+@router.get("/users", response_model=List[users.UserSchema])
+async def list_users(response: Response, limit: int = pagination.DEFAULT_PAGE_SIZE, after: Optional[int] = None,
+                     db: AsyncSession = Depends(get_async_db)):
+    err = pagination.validate_page_size(limit)
+    if err:
+        raise err
+
+    return pagination.paginate(await users.get_users_async(db=db, after=after, limit=limit + 1), limit, response)
+
+@router.post("/loans", response_model=loans.LoanSchema)
+async def create_loan(loanData: loans.LoanSchemaBase, db: AsyncSession = Depends(get_async_db)):
+    err = loans.validateLoan(loanData)
+    if err:
+        raise err
+
+    owner = await users.get_user_by_id_async(db=db, id=loanData.owner_id)
+    if not owner:
+        raise HTTPException(status_code=404, detail="User %d not found" % loanData.owner_id )
+
+    loan = await loans.create_loan_async(db=db, loanData=loanData)
+    await loan_access.add_user_async(db=db, loan_id=loan.id, user_id=loanData.owner_id)
+
+    return loan
+
+@router.get("/users/{user_id}/loans", response_model=List[loans.LoanSchema])
+async def list_user_loans(user_id: int, response: Response, limit: int = pagination.DEFAULT_PAGE_SIZE,
+                          after: Optional[int] = None, db: AsyncSession = Depends(get_async_db)):
+    err = pagination.validate_page_size(limit)
+    if err:
+        raise err
+
+    user = await users.get_user_by_id_async(db=db, id=user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User %d not found" % user_id )
+
+    page = await loan_access.get_loans_by_user_id_async(db=db, user_id=user_id, after=after, limit=limit + 1)
+    return pagination.paginate(page, limit, response)
+
+@router.post("/loans/schedules:batch", response_model=List[loans.LoanBatchScheduleSchema])
+async def get_loan_schedules(loan_ids: List[int], user_id: int, db: AsyncSession = Depends(get_async_db)):
+    if len(loan_ids) > loans.MAX_BATCH_LOANS:
+        raise HTTPException(status_code=400, detail="At most %d loans per batch" % loans.MAX_BATCH_LOANS )
+    loan_ids = list(dict.fromkeys(loan_ids))
+    visible = {loan.id: loan for loan in await loan_access.get_loans_by_ids_for_user_async(db=db, loan_ids=loan_ids, user_id=user_id)}
+    denied = [loan_id for loan_id in loan_ids if loan_id not in visible]
+    if denied:
+        raise HTTPException(status_code=403, detail="User %d does not have access to loans %s" % (user_id, ", ".join(map(str, denied))) )
+
+    # the math is CPU bound, keep it off the event loop (and in the process pool if it's big)
+    batch = [visible[loan_id] for loan_id in loan_ids]
+    schedules = await run_in_threadpool(offload.run, loans.get_loan_schedules_for_loans, batch,
+                                        size=sum(loan.term for loan in batch))
+    return Response(orjson.dumps(schedules), media_type="application/json")
+
+@router.get("/loans/{loan_id}", response_model=List[loans.LoanScheduleSchema])
+async def get_loan_schedule(loan_id: int, user_id: int, request: Request, from_month: int = 1,
+                            to_month: Optional[int] = None, format: str = "json", db: AsyncSession = Depends(get_async_db)):
+    if format not in ["json", "ndjson", "columnar"]:
+        raise HTTPException(status_code=400, detail="Schedule format must be one of 'json', 'ndjson' or 'columnar'" )
+
+    loan = await loan_access.get_loan_for_user_async(db=db, loan_id=loan_id, user_id=user_id)
+    if not loan:
+        raise HTTPException(status_code=403, detail="User %d does not have access to loan %d" % (user_id, loan_id) )
+
+    try:
+        loans.validate_month_range(loan.term, from_month, to_month if to_month is not None else loan.term)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers = conditional.cache_headers(loan)
+    if conditional.is_not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    if format == "ndjson":
+        # StreamingResponse iterates sync generators in the threadpool already
+        return StreamingResponse(loans.iter_loan_schedule_ndjson(loan, from_month, to_month), media_type="application/x-ndjson", headers=headers)
+
+    rows = await loan_schedule.get_schedule_for_loan_async(db, loan, from_month, to_month)
+    encode = loans.schedule_to_columnar_json if format == "columnar" else loans.schedule_to_json
+    return Response(encode(rows), media_type="application/json", headers=headers)
+
+@router.get("/loans/{loan_id}/month/{month}", response_model=loans.LoanSummarySchema)
+async def get_loan_summary(loan_id: int, month: int, user_id: int, request: Request, response: Response,
+                           db: AsyncSession = Depends(get_async_db)):
+    loan = await loan_access.get_loan_for_user_async(db=db, loan_id=loan_id, user_id=user_id)
+    if not loan:
+        raise HTTPException(status_code=403, detail="User %d does not have access to loan %d" % (user_id, loan_id) )
+
+    try:
+        loans.validate_month(loan.term, month)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers = conditional.cache_headers(loan)
+    if conditional.is_not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    # closed form, cheap enough to run on the event loop
+    try:
+        return await loan_schedule.get_summary_for_loan_async(db, loan, month)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.put("/loans/{loan_id}", response_model=loans.LoanSchema)
+async def update_loan(loan_id: int, loan_data: loans.LoanSchemaBase, user_id: int, db: AsyncSession = Depends(get_async_db)):
+    err = loans.validateLoan(loan_data)
+    if err:
+        raise err
+
+    loan = await loans.get_loan_by_id_async(db=db, id=loan_id)
+    if not loan:
+        raise HTTPException(status_code=404, detail="Loan %d not found" % loan_id )
+
+    if not user_id == loan.owner_id:
+        raise HTTPException(status_code=403, detail="User %d does not have access to update loan %d" % (user_id, loan_id) )
+
+    return await loans.update_loan_async(db=db, loan=loan, loanData=loan_data)
+
+@router.post("/loans/{loan_id}/share")
+async def share_loan(loan_id: int, owner_id: int, user_id: int, db: AsyncSession = Depends(get_async_db)):
+    loan_owner_id, user_exists = await loan_access.get_share_check_async(db=db, loan_id=loan_id, user_id=user_id)
+    if loan_owner_id is None:
+        raise HTTPException(status_code=404, detail="Loan %d not found" % loan_id )
+
+    if not user_exists:
+        raise HTTPException(status_code=404, detail="User %d not found" % user_id )
+
+    if loan_owner_id != owner_id:
+        raise HTTPException(status_code=403, detail="User %d does not own loan %d" % (owner_id, loan_id) )
+
+    return {"success"} if await loan_access.add_user_async(db=db, loan_id=loan_id, user_id=user_id) else {"failure"}
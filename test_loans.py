@@ -0,0 +1,160 @@
+from model import loans, amortization
+from model.cache import LRUCache
+from model.loans import LoanSchema
+import json
+import time
+import pytest
+
+# (apr, amount, term) tuples covering short personal loans through 30 year mortgages
+LOAN_PARAMS = [
+    (0.1, 1000.0, 12),
+    (0.2, 1000.0, 24),
+    (0.065, 450000.0, 360),
+    (0.0299, 32500.0, 60),
+]
+
+def iterative_summary(apr, amount, term, month):
+    # the original implementation: sum a prefix of the full schedule
+    schedule = loans.get_loan_schedule(apr, amount, term)
+    return {
+        "current_principal": schedule[month - 1].close_balance if month else amount,
+        "aggregate_principal_paid": sum(row.principal_payment for row in schedule[:month]),
+        "aggregate_interest_paid": sum(row.interest_payment for row in schedule[:month]),
+    }
+
+# Summaries
+@pytest.mark.parametrize("apr,amount,term", LOAN_PARAMS)
+def test_closed_form_summary_matches_schedule(apr, amount, term):
+    for month in range(0, term + 1):
+        expected = iterative_summary(apr, amount, term, month)
+        actual = loans.get_loan_summary(apr, amount, term, month)
+        for key in expected:
+            assert actual[key] == pytest.approx(expected[key], abs=amount * loans.SUMMARY_TOLERANCE)
+
+def test_summary_month_zero_is_exact():
+    assert loans.get_loan_summary(0.1, 1000.0, 12, 0) == {
+        "current_principal": 1000.0,
+        "aggregate_principal_paid": 0.0,
+        "aggregate_interest_paid": 0.0
+    }
+
+def test_summary_final_month_is_paid_off():
+    summary = loans.get_loan_summary(0.065, 450000.0, 360, 360)
+    assert summary["current_principal"] == pytest.approx(0, abs=1e-4)
+    assert summary["aggregate_principal_paid"] == pytest.approx(450000.0)
+
+@pytest.mark.parametrize("month", [-1, 13])
+def test_summary_month_out_of_range(month):
+    with pytest.raises(ValueError):
+        loans.get_loan_summary(0.1, 1000.0, 12, month)
+
+# Batch engine
+def test_batch_schedules_match_iterative_with_mixed_terms():
+    aprs, amounts, terms = zip(*LOAN_PARAMS)
+    schedules = amortization.get_loan_schedules(aprs, amounts, terms)
+    for i, (apr, amount, term) in enumerate(LOAN_PARAMS):
+        rows = amortization.schedule_rows(schedules, i)
+        expected = loans.get_loan_schedule(apr, amount, term)
+        assert len(rows) == term
+        for row, expected_row in zip(rows, expected):
+            for key, value in expected_row.dict().items():
+                assert row[key] == pytest.approx(value, abs=amount * loans.SUMMARY_TOLERANCE)
+
+def test_batch_summaries_match_scalar():
+    aprs, amounts, terms = zip(*LOAN_PARAMS)
+    months = [term // 2 for term in terms]
+    summaries = amortization.get_loan_summaries(aprs, amounts, terms, months)
+    for i, (apr, amount, term) in enumerate(LOAN_PARAMS):
+        expected = loans.get_loan_summary(apr, amount, term, months[i])
+        for key in expected:
+            assert summaries[key][i] == pytest.approx(expected[key], abs=amount * loans.SUMMARY_TOLERANCE)
+
+def test_batch_summaries_month_out_of_range():
+    with pytest.raises(ValueError):
+        amortization.get_loan_summaries([0.1], [1000.0], [12], [13])
+
+# Caching
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+def test_lru_cache_expires_entries(monkeypatch):
+    cache = LRUCache(maxsize=2, ttl=10)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache.set("a", 1)
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+def test_cached_schedule_is_reused_and_invalidated():
+    loan = LoanSchema(id=1, amount=5000.0, apr=0.07, term=18, owner_id=1)
+    first = loans.get_loan_schedule_for_loan(loan)
+    assert loans.get_loan_schedule_for_loan(loan) is first
+    loans.invalidate_cached_schedule(loan)
+    assert loans.get_loan_schedule_for_loan(loan) is not first
+
+def test_summary_cache_counts_each_month():
+    loan = LoanSchema(id=1, amount=7000.0, apr=0.09, term=24, owner_id=1)
+    loans.invalidate_cached_schedule(loan)
+    before = loans.cache_stats()["summary"]
+    for month in range(1, 5):
+        loans.get_loan_summary_for_loan(loan, month)
+    loans.get_loan_summary_for_loan(loan, 2)
+    after = loans.cache_stats()["summary"]
+    assert after["misses"] - before["misses"] == 4
+    assert after["hits"] - before["hits"] == 1
+
+def test_schedule_slice_matches_full_schedule():
+    full = loans.get_loan_schedule(0.065, 450000.0, 360)
+    piece = loans.get_loan_schedule(0.065, 450000.0, 360, from_month=300, to_month=310)
+    assert [row.month for row in piece] == list(range(300, 311))
+    for row, expected in zip(piece, full[299:310]):
+        assert row.close_balance == pytest.approx(expected.close_balance, abs=450000.0 * loans.SUMMARY_TOLERANCE)
+
+def test_schedule_rows_encode_like_schemas():
+    schedule = loans.get_loan_schedule(0.065, 450000.0, 360)
+    rows = loans.get_loan_schedule_rows(0.065, 450000.0, 360)
+    assert json.loads(loans.schedule_to_json(rows)) == [row.dict() for row in schedule]
+
+# Scenarios
+def rebuilt_scenario(apr, amount, term, month, extra_payment, new_apr):
+    # the slow way: walk the original schedule to month, then build a new one for the rest
+    schedule = loans.get_loan_schedule(apr, amount, term)
+    paid_interest = sum(row.interest_payment for row in schedule[:month - 1])
+    balance = schedule[month - 2].close_balance if month > 1 else amount
+    remaining = loans.get_loan_schedule(new_apr, balance - extra_payment, term - month + 1)
+    return remaining, paid_interest + sum(row.interest_payment for row in remaining)
+
+@pytest.mark.parametrize("month,extra_payment,new_apr", [(1, 0, 0.065), (120, 25000.0, 0.065), (200, 0, 0.045), (360, 1000.0, 0.08)])
+def test_scenarios_match_rebuilt_schedule(month, extra_payment, new_apr):
+    loan = LoanSchema(id=1, amount=450000.0, apr=0.065, term=360, owner_id=1)
+    scenarios = [loans.LoanScenarioSchema(month=month, extra_payment=extra_payment, apr=new_apr)]
+    result = loans.get_loan_scenarios(loan, scenarios, include_schedule=True)[0]
+    remaining, total_interest = rebuilt_scenario(0.065, 450000.0, 360, month, extra_payment, new_apr)
+
+    tolerance = 450000.0 * loans.SUMMARY_TOLERANCE
+    assert result["monthly_payment"] == pytest.approx(remaining[0].total_payment, abs=tolerance)
+    assert result["total_interest"] == pytest.approx(total_interest, abs=tolerance)
+    assert [row["month"] for row in result["schedule"]] == list(range(month, 361))
+    assert result["schedule"][-1]["close_balance"] == pytest.approx(0, abs=1e-4)
+
+def test_unchanged_scenario_saves_nothing():
+    loan = LoanSchema(id=1, amount=32500.0, apr=0.0299, term=60, owner_id=1)
+    result = loans.get_loan_scenarios(loan, [loans.LoanScenarioSchema(month=30)])[0]
+    assert result["interest_saved"] == pytest.approx(0, abs=32500.0 * loans.SUMMARY_TOLERANCE)
+    assert result["monthly_payment"] == pytest.approx(loans.calc_monthly_total_payment(0.0299, 32500.0, 60))
+    assert "schedule" not in result
+
+@pytest.mark.parametrize("scenario", [{"month": 0}, {"month": 61}, {"month": 6, "extra_payment": -1}, {"month": 6, "apr": 0}, {"month": 6, "extra_payment": 40000}])
+def test_invalid_scenarios(scenario):
+    loan = LoanSchema(id=1, amount=32500.0, apr=0.0299, term=60, owner_id=1)
+    with pytest.raises(ValueError):
+        loans.get_loan_scenarios(loan, [loans.LoanScenarioSchema(**scenario)])
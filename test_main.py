@@ -1,11 +1,28 @@
+from contextlib import contextmanager
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine, insert, delete
+from fastapi import FastAPI
+from sqlalchemy import create_engine, insert, delete, update as sql_update
+from sqlalchemy.exc import InvalidRequestError, OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
 from database.db import Base
-from main import app, get_db
+from main import app, get_db, get_read_db
+from database import db, replica
 from model.loans import Loan, LoanSchema, LoanSchemaBase
 from model.users import User, UserSchema, UserSchemaBase
+from model.cache import LRUCache
 from model.loan_access import LoanAccess
+from model import loan_access, loan_schedule, offload, export, bulk, loans
+from model.loan_schedule import LoanScheduleRow
+import config
+import routes_async
+import metrics
+import profiling
+import fastapi.dependencies.utils
+import fastapi.routing
+import asyncio
+import json
 import pytest
 
 # Configure tests to use a separate test database
@@ -18,8 +35,28 @@ def get_test_db():
 
 # Override the get_db function in the main app to use the test database
 app.dependency_overrides[get_db] = get_test_db
+app.dependency_overrides[get_read_db] = get_test_db
 test_client = TestClient(app)
 
+# The DB_MODE=async routes, mounted on their own app so both modes get tested
+# One engine for the whole run; NullPool so no connection outlives the event loop
+# TestClient starts for each request
+test_async_engine = create_async_engine("sqlite+aiosqlite:///database/test.db", poolclass=NullPool)
+
+async def get_test_async_db():
+    async with AsyncSession(test_async_engine, expire_on_commit=False) as db:
+        yield db
+
+async_app = FastAPI()
+async_app.include_router(routes_async.router)
+async_app.dependency_overrides[routes_async.get_async_db] = get_test_async_db
+async_test_client = TestClient(async_app)
+
+# The /profiles routes, which only PROFILING_ENABLED=1 adds to the main app
+profiles_app = FastAPI()
+profiles_app.include_router(profiling.router)
+profiles_test_client = TestClient(profiles_app)
+
 @pytest.fixture(scope="function")
 def engine():
     yield get_test_db_engine()
@@ -164,6 +201,67 @@ def test_view_shared_loans(setup_loan_share):
     assert response.status_code == 200
     assert len(response.json()) == 2
 
+def test_share_missing_loan_or_user(setup_loans):
+    response = test_client.post("/loans/9/share", params={"owner_id": 1, "user_id": 2})
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Loan 9 not found"}
+
+    response = test_client.post("/loans/1/share", params={"owner_id": 1, "user_id": 9})
+    assert response.status_code == 404
+    assert response.json() == {"detail": "User 9 not found"}
+
+def test_share_loan_twice(setup_loans):
+    for _ in range(2):
+        response = test_client.post("/loans/1/share", params={"owner_id": 1, "user_id": 2})
+        assert response.status_code == 200
+        assert response.json() == ["success"]
+    assert len(test_client.get("/users/2/loans").json()) == 2
+
+def test_access_cache_is_invalidated_by_share(setup_loans, monkeypatch):
+    monkeypatch.setattr(loan_access, "access_cache", LRUCache(maxsize=10))
+    assert test_client.get("/loans/1", params={"user_id": 2}).status_code == 403
+    assert loan_access.access_cache.stats()["size"] == 1
+
+    test_client.post("/loans/1/share", params={"owner_id": 1, "user_id": 2})
+    assert test_client.get("/loans/1", params={"user_id": 2}).status_code == 200
+    assert test_client.get("/loans/1/month/1", params={"user_id": 2}).status_code == 200
+    assert loan_access.access_cache.stats()["hits"] == 1
+
+def test_share_and_revoke_loans_bulk(setup_loans, test_db, monkeypatch):
+    monkeypatch.setattr(loan_access, "access_cache", LRUCache(maxsize=10))
+    test_db.add(User(username="third"))
+    test_db.add(Loan(**LOAN_ONE_BASE.dict()))
+    test_db.add(LoanAccess(user_id=1, loan_id=3))
+    test_db.commit()
+    assert test_client.get("/users/2/loans").json() == [dict(LOAN_TWO_BASE.dict(), id=2)]
+
+    shares = [{"loan_id": 1, "user_id": 2}, {"loan_id": 3, "user_id": 2}, {"loan_id": 3, "user_id": 3}, {"loan_id": 3, "user_id": 3}]
+    response = test_client.post("/loans/shares:grant", json=shares, params={"owner_id": 1})
+    assert response.status_code == 200
+    assert response.json() == {"granted": 3}
+    assert [loan["id"] for loan in test_client.get("/users/2/loans").json()] == [1, 2, 3]
+    # granting again is a no-op
+    assert test_client.post("/loans/shares:grant", json=shares, params={"owner_id": 1}).json()["granted"] == 0
+
+    response = test_client.post("/loans/shares:revoke", json=shares[:2] + [{"loan_id": 1, "user_id": 3}], params={"owner_id": 1})
+    assert response.json() == {"revoked": 2}
+    assert [loan["id"] for loan in test_client.get("/users/2/loans").json()] == [2]
+    assert test_client.get("/loans/1", params={"user_id": 2}).status_code == 403
+
+def test_share_loans_bulk_invalid(setup_loans):
+    response = test_client.post("/loans/shares:grant", json=[{"loan_id": 1, "user_id": 2}, {"loan_id": 2, "user_id": 1}], params={"owner_id": 1})
+    assert response.status_code == 403
+    assert response.json() == {"detail": "User 1 does not own loans 2"}
+    response = test_client.post("/loans/shares:grant", json=[{"loan_id": 1, "user_id": 8}, {"loan_id": 9, "user_id": 2}], params={"owner_id": 1})
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Loans 9 not found"}
+    response = test_client.post("/loans/shares:grant", json=[{"loan_id": 1, "user_id": 8}], params={"owner_id": 1})
+    assert response.json() == {"detail": "Users 8 not found"}
+    response = test_client.post("/loans/shares:revoke", json=[{"loan_id": 1, "user_id": 1}], params={"owner_id": 1})
+    assert response.status_code == 400
+    # nothing was shared by the rejected batches
+    assert test_client.get("/users/2/loans").json() == [dict(LOAN_TWO_BASE.dict(), id=2)]
+
 def test_view_unshared_loan(setup_loans):
     response = test_client.get("/loans/1", params={"user_id": 2})
     assert response.status_code == 403
@@ -187,3 +285,616 @@ def test_view_loan_summary(setup_loans):
         "aggregate_principal_paid": 0.0,
         "aggregate_interest_paid": 0.0
     }
+
+def test_view_loan_schedules_batch(setup_loan_share):
+    response = test_client.post("/loans/schedules:batch", json=[2, 1], params={"user_id": 2})
+    assert response.status_code == 200
+    assert [item["loan_id"] for item in response.json()] == [2, 1]
+    assert len(response.json()[0]["schedule"]) == LOAN_TWO_BASE.term
+    assert len(response.json()[1]["schedule"]) == LOAN_ONE_BASE.term
+
+def test_view_loan_schedules_batch_without_auth(setup_loans):
+    response = test_client.post("/loans/schedules:batch", json=[1, 2], params={"user_id": 1})
+    assert response.status_code == 403
+    assert response.json() == {"detail": "User 1 does not have access to loans 2"}
+
+def test_view_loan_schedules_batch_too_large(setup_loans, monkeypatch):
+    monkeypatch.setattr(loans, "MAX_BATCH_LOANS", 2)
+    for client in [test_client, async_test_client]:
+        response = client.post("/loans/schedules:batch", json=[1, 1, 1], params={"user_id": 1})
+        assert response.status_code == 400
+        assert response.json() == {"detail": "At most 2 loans per batch"}
+
+def test_update_loan_invalidates_cached_schedule(setup_loans):
+    test_client.get("/loans/1", params={"user_id": 1})
+    before = test_client.get("/cache/stats").json()["schedule"]
+
+    response = test_client.put("/loans/1",
+        json={"amount": 1000, "term": 12, "apr": 0.1, "status": "inactive", "owner_id": 1},
+        params = {"user_id": 1})
+    assert response.status_code == 200
+
+    after = test_client.get("/cache/stats").json()["schedule"]
+    assert after["invalidations"] == before["invalidations"] + 1
+
+def test_view_loan_schedule_range(setup_loans):
+    response = test_client.get("/loans/1", params={"user_id": 1, "from_month": 4, "to_month": 6})
+    assert response.status_code == 200
+    assert [row["month"] for row in response.json()] == [4, 5, 6]
+
+    full = test_client.get("/loans/1", params={"user_id": 1}).json()
+    for row, expected in zip(response.json(), full[3:6]):
+        assert row == pytest.approx(expected)
+
+def test_view_loan_schedule_invalid_range(setup_loans):
+    response = test_client.get("/loans/1", params={"user_id": 1, "from_month": 6, "to_month": 4})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "from_month must be less than or equal to to_month"}
+
+def test_stream_loan_schedule(setup_loans):
+    response = test_client.get("/loans/1", params={"user_id": 1, "format": "ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert rows == test_client.get("/loans/1", params={"user_id": 1}).json()
+
+
+# Async DB mode
+def test_async_create_loan(setup_users):
+    response = async_test_client.post("/loans", json=LOAN_ONE_BASE.dict())
+    assert response.status_code == 200
+    assert response.json() == LOAN_ONE_RESPONSE.dict()
+
+    response = async_test_client.get("/users/1/loans")
+    assert response.status_code == 200
+    assert response.json() == [LOAN_ONE_RESPONSE.dict()]
+
+def test_async_view_loan_schedule_and_summary(setup_loans):
+    response = async_test_client.get("/loans/1", params={"user_id": 1})
+    assert response.status_code == 200
+    assert response.json() == test_client.get("/loans/1", params={"user_id": 1}).json()
+
+    response = async_test_client.get("/loans/1/month/6", params={"user_id": 1})
+    assert response.status_code == 200
+    assert response.json() == test_client.get("/loans/1/month/6", params={"user_id": 1}).json()
+
+def test_async_share_and_update_loan(setup_loans):
+    response = async_test_client.post("/loans/1/share", params={"owner_id": 1, "user_id": 2})
+    assert response.json() == ["success"]
+    assert async_test_client.get("/loans/1", params={"user_id": 2}).status_code == 200
+
+    response = async_test_client.put("/loans/1",
+        json={"amount": 1000, "term": 12, "apr": 0.1, "status": "inactive", "owner_id": 1},
+        params = {"user_id": 2})
+    assert response.status_code == 403
+
+# Pagination
+def test_page_through_users(setup_users):
+    response = test_client.get("/users", params={"limit": 1})
+    assert response.json() == [USER_ONE_RESPONSE.dict()]
+    assert response.headers["X-Next-Cursor"] == "1"
+
+    response = test_client.get("/users", params={"limit": 1, "after": 1})
+    assert response.json() == [USER_TWO_RESPONSE.dict()]
+    assert "X-Next-Cursor" not in response.headers
+
+def test_page_through_user_loans(setup_loan_share):
+    response = test_client.get("/users/2/loans", params={"limit": 1})
+    assert [loan["id"] for loan in response.json()] == [1]
+
+    response = test_client.get("/users/2/loans", params={"limit": 1, "after": response.headers["X-Next-Cursor"]})
+    assert [loan["id"] for loan in response.json()] == [2]
+    assert "X-Next-Cursor" not in response.headers
+
+def test_invalid_page_size(test_db):
+    response = test_client.get("/users", params={"limit": 0})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "limit must be between 1 and 1000"}
+
+# Bulk ingestion
+def test_create_users_bulk(test_db):
+    response = test_client.post("/users:bulk", json=[USER_ONE_BASE.dict(), {"username": "Ty"}, USER_TWO_BASE.dict()])
+    assert response.status_code == 200
+    assert response.json() == {
+        "created": [USER_ONE_RESPONSE.dict(), USER_TWO_RESPONSE.dict()],
+        "errors": [{"index": 1, "detail": "Username must be at least 3 characters"}],
+    }
+    assert len(test_client.get("/users").json()) == 2
+
+def test_create_loans_bulk_without_sequential_ids(setup_users, test_db, monkeypatch):
+    assert bulk._ids_are_sequential(test_db, Loan)
+    # e.g. another DATABASE_URL backend: ids come from each row's own INSERT instead
+    monkeypatch.setattr(bulk, "_ids_are_sequential", lambda db, model: False)
+    response = test_client.post("/loans:bulk", json=[LOAN_ONE_BASE.dict(), LOAN_TWO_BASE.dict()])
+    assert [loan["id"] for loan in response.json()["created"]] == [1, 2]
+    assert [loan["id"] for loan in test_client.get("/users/2/loans").json()] == [2]
+
+def test_create_loans_bulk(setup_users):
+    items = [
+        LOAN_ONE_BASE.dict(),
+        dict(LOAN_ONE_BASE.dict(), owner_id=9),
+        dict(LOAN_ONE_BASE.dict(), amount=-1),
+        LOAN_TWO_BASE.dict(),
+    ]
+    response = test_client.post("/loans:bulk", json=items)
+    assert response.status_code == 200
+    assert response.json() == {
+        "created": [LOAN_ONE_RESPONSE.dict(), dict(LOAN_TWO_BASE.dict(), id=2)],
+        "errors": [
+            {"index": 1, "detail": "User 9 not found"},
+            {"index": 2, "detail": "Loan amount must be greater than zero"},
+        ],
+    }
+
+    # owners get access just like POST /loans
+    assert [loan["id"] for loan in test_client.get("/users/1/loans").json()] == [1]
+    assert [loan["id"] for loan in test_client.get("/users/2/loans").json()] == [2]
+
+def test_update_loans_bulk(setup_loans, test_db):
+    test_db.add(Loan(**dict(LOAN_ONE_BASE.dict(), status="inactive")))
+    test_db.add(LoanAccess(user_id=1, loan_id=3))
+    test_db.commit()
+    etag = test_client.get("/loans/1", params={"user_id": 1}).headers["ETag"]
+
+    response = test_client.patch("/loans:bulk", params={"user_id": 1},
+                                 json={"filter": {"status": "active"}, "changes": {"apr": 0.05}})
+    assert response.status_code == 200
+    assert response.json() == {"updated": [1]}
+
+    loans_by_id = {loan["id"]: loan for loan in test_client.get("/users/1/loans").json()}
+    assert loans_by_id[1]["apr"] == 0.05 and loans_by_id[3]["apr"] == 0.1
+    response = test_client.get("/loans/1", params={"user_id": 1}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()[0]["interest_payment"] == pytest.approx(1000 * 0.05 / 12)
+
+    # only the user's own loans match, even by id
+    response = test_client.patch("/loans:bulk", params={"user_id": 1},
+                                 json={"filter": {"loan_ids": [2, 3]}, "changes": {"status": "active"}})
+    assert response.json() == {"updated": [3]}
+
+def test_update_loans_bulk_conflict(setup_loans, test_db, monkeypatch):
+    test_db.add(Loan(**LOAN_ONE_BASE.dict()))
+    test_db.add(LoanAccess(user_id=1, loan_id=3))
+    test_db.commit()
+
+    # another writer changes loan 1 after the matches are read, before the UPDATE
+    original_update = bulk.update
+    def update_after_concurrent_write(*args, **kwargs):
+        with get_test_db_engine().begin() as connection:
+            connection.execute(sql_update(Loan).where(Loan.id == 1).values(amount=2000, version=Loan.version + 1))
+        return original_update(*args, **kwargs)
+    monkeypatch.setattr(bulk, "update", update_after_concurrent_write)
+
+    response = test_client.patch("/loans:bulk", params={"user_id": 1},
+                                 json={"filter": {"status": "active"}, "changes": {"apr": 0.05}})
+    assert response.status_code == 409
+    monkeypatch.undo()
+
+    # all or nothing: loan 3 wasn't updated without loan 1 either
+    loans_by_id = {loan["id"]: loan for loan in test_client.get("/users/1/loans").json()}
+    assert loans_by_id[1]["apr"] == 0.1 and loans_by_id[1]["amount"] == 2000
+    assert loans_by_id[3]["apr"] == 0.1
+
+def test_update_loans_bulk_invalid(setup_loans):
+    response = test_client.patch("/loans:bulk", params={"user_id": 1}, json={"changes": {}})
+    assert response.status_code == 400
+    response = test_client.patch("/loans:bulk", params={"user_id": 1}, json={"changes": {"status": "paid"}})
+    assert response.status_code == 400
+
+# Database engine profiles
+def test_production_engine(tmp_path):
+    production = db.create_db_engine("sqlite:///%s" % (tmp_path / "production.db"), "production")
+    with production.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        # NORMAL
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == config.SQLITE_BUSY_TIMEOUT_MS
+    assert isinstance(production.pool, QueuePool)
+    assert production.pool.size() == 5
+    production.dispose()
+
+def test_default_engine_is_untuned(tmp_path):
+    default = db.create_db_engine("sqlite:///%s" % (tmp_path / "default.db"), "default")
+    with default.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "delete"
+    assert "poolclass" not in db._engine_options("sqlite:///default.db", "default", QueuePool)
+    default.dispose()
+
+# Metrics
+def test_failed_query_does_not_leak_start_time(engine):
+    with engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.exec_driver_sql("SELECT * FROM missing_table")
+        assert connection.info["query_start_times"] == []
+        connection.exec_driver_sql("SELECT 1")
+        assert connection.info["query_start_times"] == []
+
+def test_metrics_by_route_template(setup_loans):
+    metrics.reset()
+    test_client.get("/loans/1", params={"user_id": 1})
+    test_client.get("/loans/1/month/3", params={"user_id": 1})
+    test_client.get("/loans/2/month/3", params={"user_id": 1})
+
+    response = test_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert 'http_requests_total{method="GET",route="/loans/{loan_id}/month/{month}",status="200"} 1' in body
+    assert 'http_requests_total{method="GET",route="/loans/{loan_id}/month/{month}",status="403"} 1' in body
+    assert 'http_request_duration_seconds_count{method="GET",route="/loans/{loan_id}"} 1' in body
+    assert 'amortization_duration_seconds_count{function="get_loan_summary_for_loan"} 1' in body
+    assert 'loan_cache_hits_total{cache="schedule"}' in body
+
+def test_metrics_count_db_queries_per_request(setup_loans):
+    metrics.reset()
+    test_client.get("/loans/1/month/3", params={"user_id": 1})
+    # one JOIN query to fetch the loan and check access
+    body = test_client.get("/metrics").text
+    assert 'http_request_db_queries_sum{method="GET",route="/loans/{loan_id}/month/{month}"} 1' in body
+
+# Portfolio
+def test_view_portfolio(setup_loan_share):
+    response = test_client.get("/users/2/portfolio", params={"month": 18})
+    assert response.status_code == 200
+    portfolio = response.json()
+    assert [(loan["loan_id"], loan["month"]) for loan in portfolio["loans"]] == [(1, 12), (2, 18)]
+
+    # matches the per-loan summary route, with loan 1 clamped to its last month
+    for loan_id, month in [(1, 12), (2, 18)]:
+        summary = test_client.get("/loans/%d/month/%d" % (loan_id, month), params={"user_id": 2}).json()
+        row = next(loan for loan in portfolio["loans"] if loan["loan_id"] == loan_id)
+        for key, value in summary.items():
+            assert row[key] == pytest.approx(value)
+
+    totals = portfolio["totals"]
+    assert totals["loan_count"] == 2
+    assert totals["amount"] == LOAN_ONE_BASE.amount + LOAN_TWO_BASE.amount
+    assert totals["aggregate_interest_paid"] == pytest.approx(sum(loan["aggregate_interest_paid"] for loan in portfolio["loans"]))
+
+def test_view_portfolio_invalid_month(setup_loans):
+    response = test_client.get("/users/1/portfolio", params={"month": -1})
+    assert response.status_code == 400
+
+    response = test_client.get("/users/9/portfolio", params={"month": 1})
+    assert response.status_code == 404
+
+
+# Materialized schedules
+@pytest.fixture()
+def materialized(monkeypatch):
+    monkeypatch.setattr(config, "SCHEDULE_STORAGE", "materialized")
+    yield
+
+def stored_months(test_db, loan_id):
+    return [row.month for row in test_db.query(LoanScheduleRow).filter(LoanScheduleRow.loan_id == loan_id).order_by(LoanScheduleRow.month)]
+
+def test_materialized_schedule_written_on_create_and_update(setup_users, materialized, test_db):
+    test_client.post("/loans", json=LOAN_ONE_BASE.dict())
+    assert stored_months(test_db, 1) == list(range(1, LOAN_ONE_BASE.term + 1))
+
+    response = test_client.put("/loans/1", json=dict(LOAN_ONE_BASE.dict(), term=6), params={"user_id": 1})
+    assert response.status_code == 200
+    assert stored_months(test_db, 1) == list(range(1, 7))
+
+    # status changes don't touch the schedule
+    response = test_client.put("/loans/1", json=dict(LOAN_ONE_BASE.dict(), term=6, status="inactive"), params={"user_id": 1})
+    assert stored_months(test_db, 1) == list(range(1, 7))
+
+def test_materialized_schedule_written_on_bulk_create(setup_users, materialized, test_db):
+    test_client.post("/loans:bulk", json=[LOAN_ONE_BASE.dict(), LOAN_TWO_BASE.dict()])
+    assert stored_months(test_db, 1) == list(range(1, LOAN_ONE_BASE.term + 1))
+    assert stored_months(test_db, 2) == list(range(1, LOAN_TWO_BASE.term + 1))
+
+def test_materialized_reads_match_live(setup_users, materialized, test_db, monkeypatch):
+    test_client.post("/loans", json=LOAN_TWO_BASE.dict())
+    stored_schedule = test_client.get("/loans/1", params={"user_id": 2, "from_month": 3, "to_month": 20}).json()
+    stored_summary = test_client.get("/loans/1/month/17", params={"user_id": 2}).json()
+
+    monkeypatch.setattr(config, "SCHEDULE_STORAGE", "live")
+    live_schedule = test_client.get("/loans/1", params={"user_id": 2, "from_month": 3, "to_month": 20}).json()
+    live_summary = test_client.get("/loans/1/month/17", params={"user_id": 2}).json()
+
+    assert len(stored_schedule) == 18
+    for stored, live in zip(stored_schedule, live_schedule):
+        assert stored == pytest.approx(live)
+    assert stored_summary == pytest.approx(live_summary)
+
+def test_materialized_backfill_and_check(setup_loans, test_db):
+    # the fixture loans were created before the schedules were stored
+    assert {loan_id for loan_id, _ in loan_schedule.check_consistency(test_db)} == {1, 2}
+    assert loan_schedule.backfill(test_db) == 2
+    assert loan_schedule.backfill(test_db) == 0
+    assert loan_schedule.check_consistency(test_db) == []
+
+def test_materialized_schedule_rewritten_on_bulk_update(setup_loans, materialized, test_db):
+    assert loan_schedule.backfill(test_db) == 2
+    test_client.patch("/loans:bulk", params={"user_id": 1}, json={"changes": {"apr": 0.05}})
+    assert loan_schedule.check_consistency(test_db) == []
+
+def test_view_loan_schedule_columnar(setup_loans):
+    rows = test_client.get("/loans/1", params={"user_id": 1}).json()
+    response = test_client.get("/loans/1", params={"user_id": 1, "format": "columnar"})
+    assert response.status_code == 200
+    columns = response.json()
+    assert list(columns) == list(rows[0])
+    for field, values in columns.items():
+        assert values == [row[field] for row in rows]
+    assert len(response.content) < len(test_client.get("/loans/1", params={"user_id": 1}).content)
+
+# Conditional GET
+def test_view_loan_schedule_not_modified(setup_loans):
+    response = test_client.get("/loans/1", params={"user_id": 1})
+    etag = response.headers["ETag"]
+    assert etag == '"1-1"'
+    assert "Last-Modified" in response.headers
+
+    response = test_client.get("/loans/1", params={"user_id": 1}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert test_client.get("/loans/1/month/6", params={"user_id": 1}, headers={"If-None-Match": "W/" + etag}).status_code == 304
+
+    # access is still checked before answering 304
+    assert test_client.get("/loans/1", params={"user_id": 2}, headers={"If-None-Match": etag}).status_code == 403
+
+def test_invalid_range_is_rejected_before_not_modified(setup_loans):
+    etag = test_client.get("/loans/1", params={"user_id": 1}).headers["ETag"]
+    for client in [test_client, async_test_client]:
+        response = client.get("/loans/1", params={"user_id": 1, "from_month": 0}, headers={"If-None-Match": etag})
+        assert response.status_code == 400
+        response = client.get("/loans/1/month/13", params={"user_id": 1}, headers={"If-None-Match": etag})
+        assert response.status_code == 400
+
+def test_update_loan_changes_etag(setup_loans):
+    etag = test_client.get("/loans/1", params={"user_id": 1}).headers["ETag"]
+    test_client.put("/loans/1",
+        json={"amount": 2000, "term": 12, "apr": 0.1, "status": "active", "owner_id": 1},
+        params = {"user_id": 1})
+
+    response = test_client.get("/loans/1", params={"user_id": 1}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"1-2"'
+    assert response.json()[0]["open_balance"] == 2000
+
+def test_async_view_loan_schedule_not_modified(setup_loans):
+    etag = async_test_client.get("/loans/1/month/6", params={"user_id": 1}).headers["ETag"]
+    response = async_test_client.get("/loans/1", params={"user_id": 1}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    async_test_client.put("/loans/1",
+        json={"amount": 2000, "term": 12, "apr": 0.1, "status": "active", "owner_id": 1},
+        params = {"user_id": 1})
+    assert async_test_client.get("/loans/1", params={"user_id": 1}, headers={"If-None-Match": etag}).status_code == 200
+
+# Process pool offload
+@pytest.fixture()
+def offload_pool(monkeypatch):
+    monkeypatch.setattr(config, "AMORTIZATION_WORKERS", 1)
+    monkeypatch.setattr(config, "AMORTIZATION_OFFLOAD_THRESHOLD", 30)
+    yield
+    offload.shutdown()
+
+def test_offloaded_batch_matches_inline(setup_loan_share, offload_pool):
+    # 12 + 24 loan-months is over the threshold, 12 alone isn't
+    metrics.reset()
+    pooled = test_client.post("/loans/schedules:batch", json=[2, 1], params={"user_id": 2}).json()
+    inline = test_client.post("/loans/schedules:batch", json=[1], params={"user_id": 2}).json()
+    assert pooled[1] == inline[0]
+    assert len(pooled[0]["schedule"]) == LOAN_TWO_BASE.term
+
+    body = test_client.get("/metrics").text
+    assert 'amortization_jobs_total{function="get_loan_schedules_for_loans",executor="pool"} 1' in body
+    assert 'amortization_jobs_total{function="get_loan_schedules_for_loans",executor="inline"} 1' in body
+    assert "amortization_pool_wait_seconds_count 1" in body
+
+def test_offload_rejects_jobs_past_the_queue_limit(setup_loan_share, offload_pool, monkeypatch):
+    # the only slot is taken and one job is already waiting for it
+    monkeypatch.setattr(config, "AMORTIZATION_MAX_QUEUED", 1)
+    _, slots = offload._pool()
+    slots.acquire()
+    monkeypatch.setattr(offload, "_queued", 1)
+    try:
+        response = test_client.post("/loans/schedules:batch", json=[2, 1], params={"user_id": 2})
+        assert response.status_code == 503
+        assert 'amortization_jobs_total{function="get_loan_schedules_for_loans",executor="rejected"} 1' in test_client.get("/metrics").text
+        # small jobs still run inline
+        assert test_client.post("/loans/schedules:batch", json=[1], params={"user_id": 2}).status_code == 200
+    finally:
+        slots.release()
+
+def test_offloaded_portfolio_errors_are_reported(setup_loans, offload_pool, monkeypatch):
+    monkeypatch.setattr(config, "AMORTIZATION_OFFLOAD_THRESHOLD", 1)
+    assert test_client.get("/users/1/portfolio", params={"month": 6}).status_code == 200
+    assert test_client.get("/users/1/portfolio", params={"month": -1}).status_code == 400
+
+# Query budgets
+@pytest.fixture()
+def max_queries():
+    """with max_queries(n): fails the test if the block runs more than n statements"""
+    @contextmanager
+    def check(budget: int):
+        with metrics.count_queries() as queries:
+            yield queries
+        assert queries.count <= budget, "%d queries, budget %d:\n%s" % (queries.count, budget, "\n".join(queries.statements))
+    return check
+
+# (method, url, request kwargs, budget, has an async version)
+QUERY_BUDGETS = [
+    ("GET", "/users", {}, 1, True),
+    ("POST", "/users", {"json": {"username": "third"}}, 2, True),
+    ("POST", "/users:bulk", {"json": [{"username": "bulk1"}, {"username": "bulk2"}]}, 2, False),
+    ("POST", "/loans", {"json": LOAN_ONE_BASE.dict()}, 5, True),
+    ("POST", "/loans:bulk", {"json": [LOAN_ONE_BASE.dict(), LOAN_TWO_BASE.dict()]}, 4, False),
+    ("PATCH", "/loans:bulk", {"params": {"user_id": 1}, "json": {"changes": {"apr": 0.05}}}, 2, False),
+    ("GET", "/users/1/loans", {}, 2, True),
+    ("GET", "/users/2/portfolio", {"params": {"month": 6}}, 2, False),
+    ("GET", "/users/2/portfolio/export", {"params": {"schedule": True}}, 2, False),
+    ("GET", "/loans/1", {"params": {"user_id": 1}}, 1, True),
+    ("GET", "/loans/1/month/6", {"params": {"user_id": 1}}, 1, True),
+    ("POST", "/loans/schedules:batch", {"params": {"user_id": 2}, "json": [1, 2]}, 1, True),
+    ("POST", "/loans/1/scenarios", {"params": {"user_id": 1}, "json": [{"month": 3, "extra_payment": 100}]}, 1, False),
+    ("PUT", "/loans/1", {"params": {"user_id": 1}, "json": LOAN_ONE_BASE.dict()}, 3, True),
+    ("POST", "/loans/1/share", {"params": {"owner_id": 1, "user_id": 2}}, 2, True),
+    ("POST", "/loans/shares:grant", {"params": {"owner_id": 1}, "json": [{"loan_id": 1, "user_id": 2}]}, 3, False),
+    ("POST", "/loans/shares:revoke", {"params": {"owner_id": 1}, "json": [{"loan_id": 1, "user_id": 2}]}, 2, False),
+]
+
+@pytest.mark.parametrize("method,url,kwargs,budget,has_async", QUERY_BUDGETS)
+def test_query_budget(setup_loan_share, max_queries, method, url, kwargs, budget, has_async):
+    clients = [test_client, async_test_client] if has_async else [test_client]
+    for client in clients:
+        with max_queries(budget):
+            assert client.request(method, url, **kwargs).status_code == 200
+
+def test_listing_budget_does_not_grow_with_rows(setup_users, test_db, max_queries):
+    test_db.execute(insert(Loan), [dict(LOAN_ONE_BASE.dict(), owner_id=1) for _ in range(20)])
+    test_db.execute(insert(LoanAccess), [{"loan_id": loan_id, "user_id": 1} for loan_id in range(1, 21)])
+    test_db.commit()
+    with max_queries(2):
+        assert len(test_client.get("/users/1/loans").json()) == 20
+
+def test_listing_relationships_do_not_lazy_load(setup_loans, test_db):
+    loan = loan_access.get_loans_by_user_id(test_db, user_id=1)[0]
+    with pytest.raises(InvalidRequestError):
+        loan.owner
+
+# Scenarios
+def test_loan_scenarios(setup_loan_share):
+    scenarios = [{"month": 6, "extra_payment": 200}, {"month": 6, "apr": 0.05}, {"month": 12}]
+    response = test_client.post("/loans/1/scenarios", json=scenarios, params={"user_id": 2, "schedule": True})
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["month"] for result in results] == [6, 6, 12]
+    assert results[0]["interest_saved"] > 0 and results[1]["interest_saved"] > 0
+    assert results[0]["balance"] == pytest.approx(test_client.get("/loans/1/month/5", params={"user_id": 1}).json()["current_principal"])
+    assert [row["month"] for row in results[2]["schedule"]] == [12]
+
+def test_loan_scenarios_invalid(setup_loans):
+    assert test_client.post("/loans/2/scenarios", json=[{"month": 1}], params={"user_id": 1}).status_code == 403
+    response = test_client.post("/loans/1/scenarios", json=[{"month": 13}], params={"user_id": 1})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Scenario month must be between 1 and the loan term"}
+
+# Read replica routing
+@pytest.fixture()
+def replica_db(engine, setup_loans, monkeypatch):
+    # a second SQLite file stands in for a replica that hasn't caught up: same tables, no rows
+    replica_engine = create_engine("sqlite:///database/test_replica.db", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(replica_engine)
+    monkeypatch.setattr(db, "engine", engine)
+    monkeypatch.setattr(db, "read_engine", replica_engine)
+    monkeypatch.delitem(app.dependency_overrides, get_read_db)
+    replica.recent_writers.clear()
+    yield replica_engine
+    Base.metadata.drop_all(replica_engine)
+
+def test_reads_use_replica_until_user_writes(replica_db):
+    metrics.reset()
+    # loan 1 is only on the primary so far
+    assert test_client.get("/loans/1", params={"user_id": 1}).status_code == 403
+    assert test_client.get("/users").json() == []
+
+    test_client.put("/loans/1", json=LOAN_ONE_BASE.dict(), params={"user_id": 1})
+    assert test_client.get("/loans/1", params={"user_id": 1}).status_code == 200
+    assert [loan["id"] for loan in test_client.get("/users/1/loans").json()] == [1]
+    # user 2 didn't write, so still reads the lagging replica
+    assert test_client.get("/users/2/loans").status_code == 404
+
+    body = test_client.get("/metrics").text
+    assert 'db_read_sessions_total{target="replica"} 3' in body
+    assert 'db_read_sessions_total{target="primary"} 2' in body
+
+def test_reads_fall_back_to_primary(replica_db, monkeypatch):
+    monkeypatch.setattr(db, "read_engine", create_engine("sqlite:///file:database/missing_replica.db?mode=ro&uri=true"))
+    assert test_client.get("/loans/1", params={"user_id": 1}).status_code == 200
+
+    monkeypatch.setattr(config, "READ_REPLICA_FALLBACK", False)
+    with pytest.raises(OperationalError):
+        test_client.get("/loans/1", params={"user_id": 1})
+
+# Portfolio export
+def test_export_portfolio_csv(setup_loan_share):
+    response = test_client.get("/users/2/portfolio/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.text.splitlines() == [
+        "id,amount,apr,term,status,owner_id",
+        "1,1000.0,0.1,12,active,1",
+        "2,1000.0,0.2,24,active,2",
+    ]
+
+    lines = test_client.get("/users/2/portfolio/export", params={"schedule": True}).text.splitlines()
+    assert lines[0].endswith(",owner_id,month,open_balance,total_payment,principal_payment,interest_payment,close_balance")
+    assert len(lines) == 1 + LOAN_ONE_BASE.term + LOAN_TWO_BASE.term
+
+def test_export_portfolio_ndjson_in_batches(setup_loan_share, monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_BATCH_SIZE", 1)
+    response = test_client.get("/users/2/portfolio/export", params={"format": "ndjson", "schedule": True})
+    assert response.status_code == 200
+    items = [json.loads(line) for line in response.text.splitlines()]
+    assert [item["id"] for item in items] == [1, 2]
+    batch = test_client.post("/loans/schedules:batch", json=[1, 2], params={"user_id": 2}).json()
+    assert [item["schedule"] for item in items] == [item["schedule"] for item in batch]
+
+def test_export_portfolio_invalid(setup_loans):
+    assert test_client.get("/users/9/portfolio/export").status_code == 404
+    assert test_client.get("/users/1/portfolio/export", params={"format": "xlsx"}).status_code == 400
+    assert test_client.get("/users/1/portfolio/export", params={"format": "ndjson"}).text.count("\n") == 1
+
+# Profiling
+@pytest.fixture()
+def profiled_client(monkeypatch):
+    # what profiling.install does, without leaving the shared app patched for other tests
+    monkeypatch.setattr(fastapi.routing, "run_in_threadpool", profiling._run_in_threadpool)
+    monkeypatch.setattr(fastapi.dependencies.utils, "run_in_threadpool", profiling._run_in_threadpool)
+    monkeypatch.setattr(profiling, "reports", LRUCache(maxsize=10))
+    yield TestClient(profiling.ProfilingMiddleware(app))
+
+def test_profile_request(setup_loans, profiled_client):
+    response = profiled_client.get("/loans/1", params={"user_id": 1}, headers={"X-Profile": "1"})
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+
+    report = profiles_test_client.get("/profiles/%s" % profile_id).json()
+    assert (report["method"], report["path"], report["status"]) == ("GET", "/loans/1", 200)
+    # the event loop plus the route and its response validation in the threadpool
+    assert report["segments"] >= 2
+    assert set(report["categories"]) == set(profiling.CATEGORIES)
+    assert report["categories"]["sqlalchemy"] > 0
+    assert report["categories"]["amortization"] > 0
+    assert len(report["top"]) == profiling.TOP_FUNCTIONS
+    assert [profile["id"] for profile in profiles_test_client.get("/profiles").json()] == [profile_id]
+
+def test_profile_excludes_other_requests_on_the_loop(monkeypatch):
+    monkeypatch.setattr(profiling, "reports", LRUCache(maxsize=10))
+
+    async def profiled_app(scope, receive, send):
+        await asyncio.sleep(0.01)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def unprofiled_request():
+        for _ in range(5):
+            sum(range(10000))
+            await asyncio.sleep(0)
+
+    async def send(message):
+        pass
+
+    scope = {"type": "http", "method": "GET", "path": "/", "query_string": b"", "headers": [(b"x-profile", b"1")]}
+    async def run_both():
+        await asyncio.gather(profiling.ProfilingMiddleware(profiled_app)(scope, None, send), unprofiled_request())
+    asyncio.run(run_both())
+
+    (report,) = profiling.reports.values()
+    functions = [function["function"] for function in report["top"]]
+    assert any("profiled_app" in function for function in functions)
+    assert not any("unprofiled_request" in function for function in functions)
+
+def test_profiling_is_opt_in(setup_loans, profiled_client):
+    assert "X-Profile-Id" not in profiled_client.get("/loans/1", params={"user_id": 1}).headers
+    # PROFILING_ENABLED is off for the main app, so the header does nothing there
+    assert "X-Profile-Id" not in test_client.get("/loans/1", params={"user_id": 1}, headers={"X-Profile": "1"}).headers
+    # and the /profiles routes aren't there either
+    assert test_client.get("/profiles").status_code == 404
+    assert profiles_test_client.get("/profiles").json() == []
+    assert profiles_test_client.get("/profiles/missing").status_code == 404